@@ -1,13 +1,15 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, Form
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, Depends, Header, HTTPException, UploadFile, Form
+from fastapi.responses import Response
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlmodel import select
-from pydantic import BaseModel
-from db import Database
+from pydantic import BaseModel, Field
+from db import Database, blobs
 from db.models import *
 from typing import Optional
 from utils.sessions import authorize
-from utils.assetutil import hash_bytes
-import io
+from utils.responses import RangeFileResponse
+import asyncio
+import os
 import db
 import base64
 import hashlib
@@ -15,9 +17,46 @@ import hashlib
 
 router = APIRouter(tags=["assets"])
 
+# ASSET_CACHE_CONTROL lets clients keep assets for a year without asking again.
+# Assets are addressed by the hash of their data, so an asset never changes.
+# They may be private photos, so shared caches must not keep them.
+ASSET_CACHE_CONTROL = "private, max-age=31536000, immutable"
 
-@router.get(
+
+def asset_cache_headers(asset_hash: str) -> dict[str, str]:
+    """
+    This function returns the caching headers of an asset. Its hash is used as
+    a strong ETag.
+    """
+    return {"ETag": f'"{asset_hash}"', "Cache-Control": ASSET_CACHE_CONTROL}
+
+
+async def assert_asset_modified(
+    asset_hash: str,
+    if_none_match: Optional[str] = Header(default=None),
+) -> None:
+    """
+    This function answers with 304 Not Modified if the client already has the
+    asset. It must come before any other dependency, so that revalidating a
+    cached asset never touches the database.
+    """
+    if if_none_match is None:
+        return
+
+    # "*" is not matched here, since it only matches assets that exist, which
+    # is not known without the database.
+    etag = f'"{asset_hash}"'
+    for tag in if_none_match.split(","):
+        tag = tag.strip().removeprefix("W/")
+        if tag == etag:
+            raise HTTPException(
+                status_code=304, headers=asset_cache_headers(asset_hash)
+            )
+
+
+@router.api_route(
     "/assets/{asset_hash}",
+    methods=["GET", "HEAD"],
     responses={
         200: {
             "content": {
@@ -25,24 +64,49 @@ router = APIRouter(tags=["assets"])
                 "application/json": None,
             },
             "description": "Return the bytes of the asset in body",
-        }
+        },
+        206: {"description": "Return the requested range of the asset's bytes"},
+        304: {"description": "The client already has the asset"},
+        416: {"description": "The requested range lies outside of the asset"},
     },
 )
 async def get_asset(
     asset_hash: str,
+    _=Depends(assert_asset_modified),
     db: Database = Depends(db.use),
     me: str = Depends(authorize),
-) -> StreamingResponse:
+) -> Response:
     """
-    This function returns an asset by hash.
+    This function returns an asset by hash. A HEAD request only checks that
+    the asset exists, which lets clients skip uploading it again.
     """
 
     asset = (await db.exec(select(Asset).where(Asset.hash == asset_hash))).first()
     if asset is None:
         raise HTTPException(status_code=404, detail="Not found")
 
-    stream = io.BytesIO(asset.data)
-    return StreamingResponse(stream, media_type=asset.content_type)
+    path = blobs.store.path(asset.hash)
+    if path is None:
+        data = await blobs.store.get(asset.hash)
+        if data is None:
+            raise HTTPException(status_code=404, detail="Not found")
+        return Response(
+            data,
+            media_type=asset.content_type,
+            headers=asset_cache_headers(asset.hash),
+        )
+
+    try:
+        stat_result = await asyncio.to_thread(os.stat, path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Not found")
+
+    return RangeFileResponse(
+        path,
+        stat_result=stat_result,
+        media_type=asset.content_type,
+        headers=asset_cache_headers(asset.hash),
+    )
 
 
 class GetAssetMetadataResponse(BaseModel):
@@ -67,6 +131,13 @@ async def get_asset_metadata(
     return GetAssetMetadataResponse(**asset.model_dump())
 
 
+# UPLOAD_LIMIT is the largest asset that can be uploaded, in bytes.
+UPLOAD_LIMIT = 1024 * 1024 * 5  # 5 MB
+
+# UPLOAD_CHUNK_SIZE is how much of an upload is read at once, in bytes.
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
 class UploadFileResponse(BaseModel):
     hash: str
     content_type: str
@@ -83,29 +154,54 @@ async def upload_asset(
     """
     Uploads an asset and returns its hash.
     """
-    UPLOAD_LIMIT = 1024 * 1024 * 5  # 5 MB
-
     if file.content_type is None:
         raise HTTPException(status_code=400, detail="Content-Type header is required")
 
-    if file.size is None or file.size > UPLOAD_LIMIT:
+    if file.size is not None and file.size > UPLOAD_LIMIT:
         raise HTTPException(status_code=400, detail="File is too large")
 
-    data = await file.read()
-    hash = hash_bytes(data)
-    content_type = file.content_type
-
-    asset = Asset(
-        hash=hash,
-        data=data,
-        content_type=content_type,
-        alt=alt if alt else None,
+    # The file is read in chunks and hashed as it is written, so that neither
+    # the whole upload nor its hashing ever sits on the event loop.
+    async with blobs.store.writer() as writer:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            if writer.size + len(chunk) > UPLOAD_LIMIT:
+                raise HTTPException(status_code=400, detail="File is too large")
+            await writer.write(chunk)
+        hash = await writer.commit()
+
+    # Uploading an asset that already exists keeps the existing one, so that
+    # retried and repeated uploads succeed.
+    await db.exec(
+        sqlite_insert(Asset)
+        .values(hash=hash, content_type=file.content_type, alt=alt if alt else None)
+        .on_conflict_do_nothing()  # type: ignore
     )
-    db.add(asset)
+    asset = await db.get(Asset, hash)
+    assert asset is not None
 
     return UploadFileResponse(**asset.model_dump())
 
 
+class CheckAssetsRequest(BaseModel):
+    hashes: list[str] = Field(max_length=1000)
+
+
+@router.post("/assets/check")
+async def check_assets(
+    req: CheckAssetsRequest,
+    db: Database = Depends(db.use),
+    _=Depends(authorize),
+) -> list[str]:
+    """
+    This function returns which of the given asset hashes already exist, so
+    that clients only need to upload the others.
+    """
+    hashes = await db.exec(
+        select(Asset.hash).where(Asset.hash.in_(req.hashes))  # type: ignore
+    )
+    return list(hashes)
+
+
 async def assert_asset_hash(db: Database, hash: str):
     asset = (await db.exec(select(Asset.hash).where(Asset.hash == hash))).first()
     if asset is None:
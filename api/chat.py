@@ -1,91 +1,286 @@
-from fastapi import APIRouter, Depends, HTTPException, WebSocket
+from fastapi import (
+    APIRouter,
+    Depends,
+    Header,
+    HTTPException,
+    Query,
+    WebSocket,
+    WebSocketDisconnect,
+)
+from sqlalchemy import and_
+from sqlalchemy.exc import IntegrityError
 from sqlmodel import select, col
-from pydantic import BaseModel, Field
-from db import Database
+from pydantic import BaseModel, Field, ValidationError
+from db import Database, InsertBatcher, Loader, fts, inbox
 from db.models import *
-from utils.sessions import authorize
-from typing import Sequence, Union
+from utils.sessions import authorize, session_user_id
+from typing import AsyncGenerator, AsyncIterator, Literal, Sequence, Union
 from api.assets import assert_asset_hash
 import db
-from viewlevels.group import assert_group_open_dms, group_level
-from viewlevels.user import UserView, user_view_from_db
-from sse_starlette.sse import EventSourceResponse, AsyncContentStream
-from broadcaster import Broadcast
-from datetime import datetime
+from viewlevels.group import assert_group_open_dms, group_open_dms
+from viewlevels.user import (
+    UserView,
+    user_level,
+    user_views_by_level,
+    user_views_from_db,
+)
+from sse_starlette.sse import EventSourceResponse, AsyncContentStream, ServerSentEvent
+from utils.broadcast import Broadcast, BroadcastStats, SlowSubscriberPolicy
+from contextlib import aclosing
+from dataclasses import dataclass
+from datetime import datetime, timedelta
 import asyncio
+import functools
+import json
+import logging
 
 router = APIRouter(tags=["chat"])
 
-broadcast = Broadcast("memory://")
+logger = logging.getLogger(__name__)
+
+# LIVE_QUEUE_SIZE is how many messages a live stream may fall behind by
+# before LIVE_SLOW_SUBSCRIBERS decides what happens to it. Disconnecting is
+# the default, since the client resumes from its Last-Event-ID without losing
+# any messages.
+LIVE_QUEUE_SIZE = 256
+LIVE_SLOW_SUBSCRIBERS: SlowSubscriberPolicy = "disconnect"
+
+# MAX_LIVE_CONNECTIONS is how many live streams this process serves at once.
+MAX_LIVE_CONNECTIONS = 20000
+
+# LIVE_PING_INTERVAL is how often, in seconds, idle live streams are sent a
+# heartbeat to keep proxies from closing them. A stream whose client does not
+# read an event within LIVE_SEND_TIMEOUT seconds is closed.
+LIVE_PING_INTERVAL = 15
+LIVE_SEND_TIMEOUT = 30.0
+
+broadcast = Broadcast(
+    "memory://",
+    queue_size=LIVE_QUEUE_SIZE,
+    slow_subscribers=LIVE_SLOW_SUBSCRIBERS,
+)
+
+
+def set_broadcast_url(url: str) -> None:
+    """
+    This function sets the URL of the backend that live chat messages are
+    broadcast through. It must be called before the broadcast is connected.
+    """
+    global broadcast
+    broadcast = Broadcast(
+        url,
+        queue_size=LIVE_QUEUE_SIZE,
+        slow_subscribers=LIVE_SLOW_SUBSCRIBERS,
+    )
+
+
+class ChatMessageResponse(BaseModel):
+    id: int
+    group_id: int
+    author_id: int
+    author: UserView
+    content: ChatContent
+    created_at: datetime
+
+
+async def chat_message_responses(
+    db: Database,
+    me_id: int,
+    messages: Sequence[ChatMessage],
+) -> list[ChatMessageResponse]:
+    """
+    This function builds the ChatMessageResponse of every given message. Each
+    distinct author's view is only loaded once.
+    """
+    authors = await user_views_from_db(
+        db,
+        me_id,
+        {message.author_id for message in messages if message.author_id is not None},
+    )
+    return [
+        ChatMessageResponse(
+            **message.model_dump(),
+            author=authors[message.author_id],
+        )
+        for message in messages
+        if message.author_id in authors
+    ]
+
+
+class ChatGroupResponse(BaseModel):
+    id: int
+    name: str
+    bio: str
+    color: str
+    icon_hash: Optional[str]
+    lat: float
+    lon: float
+    has_house: bool
+    last_message: Optional[ChatMessageResponse]
+    last_read_id: Optional[int]
+    unread_count: int
 
 
 @router.get("/chat/groups")
 async def get_chat_groups(
     db: Database = Depends(db.use),
     me_id: int = Depends(authorize),
-) -> Sequence[Group]:
+) -> Sequence[ChatGroupResponse]:
     """
     This function returns chat groups that the current user currently has an
-    open DM with.
+    open DM with, along with their last message and the user's unread count.
+    Groups with the most recent messages come first.
     """
-    return (
+    rows = (
         await db.exec(
-            select(Group)
+            select(Group, ChatGroupState, ChatReadCursor, ChatMessage)
             .join(GroupRelationship)
+            .outerjoin(ChatGroupState)
+            .outerjoin(
+                ChatReadCursor,
+                and_(
+                    col(ChatReadCursor.group_id) == Group.id,
+                    col(ChatReadCursor.user_id) == me_id,
+                ),
+            )
+            .outerjoin(
+                ChatMessage,
+                col(ChatMessage.id) == ChatGroupState.last_message_id,
+            )
             .where(
-                GroupRelationship.user_id == me_id
-                and GroupRelationship.open_dms == True
+                GroupRelationship.user_id == me_id,
+                GroupRelationship.open_dms == True,
             )
+            .order_by(col(ChatGroupState.last_message_id).desc().nulls_last())
         )
     ).all()
 
+    last_messages = await chat_message_responses(
+        db,
+        me_id,
+        [message for *_, message in rows if message is not None],
+    )
+    last_messages_by_group = {message.group_id: message for message in last_messages}
 
-class ChatMessageResponse(BaseModel):
-    id: int
-    group_id: int
-    author_id: int
-    author: UserView
-    content: ChatContent
-    created_at: datetime
+    responses: list[ChatGroupResponse] = []
+    for group, state, cursor, _ in rows:
+        message_count = state.message_count if state else 0
+        read_count = cursor.read_count if cursor else 0
+        responses.append(
+            ChatGroupResponse(
+                **group.model_dump(),
+                last_message=last_messages_by_group.get(group.id),
+                last_read_id=cursor.last_read_id if cursor else None,
+                unread_count=max(message_count - read_count, 0),
+            )
+        )
+    return responses
+
+
+@router.get("/chat/groups/{group_id}/messages/search")
+async def search_chat_messages(
+    group_id: int,
+    q: str,
+    limit: int = Query(20, ge=1),
+    offset: int = 0,
+    db: Database = Depends(db.use),
+    me_id: int = Depends(authorize),
+) -> Sequence[ChatMessageResponse]:
+    """
+    This function returns the text messages of a group that contain every word
+    of the query, best matches first. Use offset to get the following pages.
+    """
+    await assert_group_open_dms(db, me_id, group_id)
+
+    if limit > 100:
+        limit = 100
+
+    ids = await fts.search_messages(db, group_id, q, limit, max(offset, 0))
+    messages = await Loader.of(db).get_many(ChatMessage, ids)
+    return await chat_message_responses(
+        db,
+        me_id,
+        [messages[id] for id in ids if id in messages],
+    )
+
+
+class ReadChatMessagesRequest(BaseModel):
+    message_id: int
+
+
+@router.post("/chat/groups/{group_id}/read")
+async def read_chat_messages(
+    group_id: int,
+    req: ReadChatMessagesRequest,
+    db: Database = Depends(db.use),
+    me_id: int = Depends(authorize),
+) -> None:
+    """
+    This function marks the messages of a group up to the given message as read
+    by the current user.
+    """
+    await assert_group_open_dms(db, me_id, group_id)
+    await inbox.mark_read(db, me_id, group_id, req.message_id)
 
 
 @router.get("/chat/groups/{group_id}/messages")
 async def get_chat_messages(
     group_id: int,
     before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
     limit: int = 50,
     db: Database = Depends(db.use),
     me_id: int = Depends(authorize),
 ) -> Sequence[ChatMessageResponse]:
     """
     This function returns chat messages for a group that the current user is in.
+
+    By default, the newest messages (before before_id, if given) are returned
+    newest first. If after_id is given, the messages right after it are
+    returned oldest first instead, which lets clients catch up on what they
+    missed.
     """
-    assert assert_group_open_dms(db, me_id, group_id)
+    await assert_group_open_dms(db, me_id, group_id)
 
     if limit > 100:
         limit = 100
 
-    messages_with_author = (
+    order = col(ChatMessage.id).desc()
+    if after_id is not None:
+        order = col(ChatMessage.id).asc()
+
+    messages = (
         await db.exec(
-            select(ChatMessage, User)
-            .join(User)
+            select(ChatMessage)
             .where(
-                ChatMessage.group_id == group_id
-                and User.id == ChatMessage.author_id
-                and (ChatMessage.id < before_id if before_id is not None else True)
+                ChatMessage.group_id == group_id,
+                (ChatMessage.id < before_id if before_id is not None else True),
+                (ChatMessage.id > after_id if after_id is not None else True),
             )
-            .order_by(col(ChatMessage.id).desc())
+            .order_by(order)
             .limit(limit)
         )
     ).all()
-    level = await group_level(db, me_id, group_id)
-    return [
-        ChatMessageResponse(
-            **message.model_dump(),
-            author=await user_view_from_db(db, me_id, user.id),
-        )
-        for message, user in messages_with_author
-    ]
+    return await chat_message_responses(db, me_id, messages)
+
+
+async def record_chat_messages(db: Database, messages: Sequence[ChatMessage]) -> None:
+    """
+    This function updates everything that is derived from chat messages for
+    the new messages, in the transaction that inserts them.
+    """
+    await inbox.add_messages(db, messages)
+    await fts.index_messages(db, messages)
+
+
+# chat_message_writer commits the chat messages sent at about the same time
+# together, so that every message does not pay for its own commit.
+chat_message_writer: InsertBatcher[ChatMessage] = InsertBatcher(
+    lambda: db.get(expire_on_commit=False),
+    max_delay=timedelta(milliseconds=5),
+    max_size=256,
+    before_commit=record_chat_messages,
+)
 
 
 class SendChatMessageRequest(BaseModel):
@@ -102,44 +297,385 @@ async def send_chat_message(
     """
     This function sends a chat message to a group.
     """
+    return await post_chat_message(db, me_id, group_id, req.content)
+
+
+async def post_chat_message(
+    db: Database,
+    me_id: int,
+    group_id: int,
+    content: ChatContent,
+) -> ChatMessageResponse:
+    """
+    This function sends a chat message to a group and broadcasts it to the
+    group's live streams. The message is committed by chat_message_writer
+    together with others, not by the given session.
+    """
     await assert_group_open_dms(db, me_id, group_id)
 
-    if isinstance(req.content, ChatContentSticker):
-        await assert_asset_hash(db, req.content.asset_hash)
-    if isinstance(req.content, ChatContentImage):
-        await assert_asset_hash(db, req.content.asset_hash)
+    if isinstance(content, ChatContentSticker):
+        await assert_asset_hash(db, content.asset_hash)
+    if isinstance(content, ChatContentImage):
+        await assert_asset_hash(db, content.asset_hash)
 
-    await broadcast.publish(channel=str(group_id), message=req.content)
     message = ChatMessage(
         group_id=group_id,
         author_id=me_id,
-        content=req.content,
+        content=content,
     )
+    try:
+        message = await chat_message_writer.insert(message)
+    except IntegrityError:
+        # The group or the author went away after the checks above.
+        raise HTTPException(status_code=409, detail="Conflict")
 
-    db.add(message)
-    await db.commit()
-    await db.refresh(message)
+    me = await Loader.of(db).get(User, me_id)
+    assert me is not None
+    responses = {
+        level: ChatMessageResponse(**message.model_dump(), author=author)
+        for level, author in (await user_views_by_level(db, me)).items()
+    }
 
-    me = (await db.exec(select(User).where(User.id == me_id))).one()
-    return ChatMessageResponse(
-        **message.model_dump(),
-        author=await user_view_from_db(db, me_id, me.id),
-    )
+    # Only announce the message once it is committed, so that live streams
+    # never miss it when replaying. Failing to announce it must not fail the
+    # request, or the client would send the committed message again. Live
+    # streams still get it once they reconnect.
+    try:
+        await broadcast.publish(
+            channel=str(group_id),
+            message=encode_chat_envelope(message, me, responses),
+        )
+    except Exception:
+        logger.exception("publishing chat message %d failed", message.id)
+
+    return responses[AccessLevel.HIGHEST]
 
 
 @router.get("/chat/groups/{group_id}/messages/live")
 async def live_chat_messages(
     group_id: int,
+    last_event_id: Optional[int] = Header(default=None),
     db: Database = Depends(db.use),
     me_id: int = Depends(authorize),
 ) -> EventSourceResponse:
-    async def ws_messages():
-        async with broadcast.subscribe(channel=str(group_id)) as subscriber:
-            async for event in subscriber:
-                yield event
+    """
+    This function streams the chat messages sent to a group as server-sent
+    events. Each event's ID is the ID of its message.
 
+    When reconnecting with a Last-Event-ID header, as browsers do on their own,
+    the messages sent after that event are replayed first.
+    """
     await assert_group_open_dms(db, me_id, group_id)
-    return EventSourceResponse(ws_messages())
+
+    if live_connections_full():
+        raise HTTPException(
+            status_code=503,
+            detail="Too many live connections",
+            headers={"Retry-After": str(LIVE_PING_INTERVAL)},
+        )
+
+    return EventSourceResponse(
+        live_chat_events(group_id, me_id, last_event_id),
+        ping=LIVE_PING_INTERVAL,
+        send_timeout=LIVE_SEND_TIMEOUT,
+    )
+
+
+class ChatWebSocketRequest(SendChatMessageRequest):
+    type: Literal["send"]
+    # nonce is echoed back in the reply to this request.
+    nonce: Optional[str] = None
+
+
+class ChatWebSocketReply(BaseModel):
+    type: Literal["sent"]
+    nonce: Optional[str]
+    message: ChatMessageResponse
+
+
+@router.websocket("/chat/groups/{group_id}/ws")
+async def chat_websocket(
+    websocket: WebSocket,
+    group_id: int,
+    after_id: Optional[int] = None,
+) -> None:
+    """
+    This function serves a group's chat over a WebSocket, which both receives
+    the group's messages and sends new ones without a request per message.
+
+    The session token is given either as a bearer Authorization header or, for
+    browsers, which cannot set headers on WebSockets, as the subprotocols
+    "bearer" and the token, in that order. The server then picks "bearer". It
+    is never taken from the URL, which ends up in access logs. Messages after
+    after_id are replayed first, like with Last-Event-ID for live streams.
+
+    Every frame is a JSON object with a type:
+
+      - The client sends {"type": "send", "nonce": ..., "content": ...}.
+      - The server replies with {"type": "sent", "nonce": ..., "message": ...}
+        or {"type": "error", "nonce": ..., "detail": ...}.
+      - The server sends {"type": "message", "message": ...} for every message
+        in the group, including the client's own.
+
+    The socket is closed with code 1008 if the user may not chat in the group,
+    and with 1013 if the server is too busy or the client fell too far behind,
+    in which case it should reconnect with after_id.
+    """
+    token = None
+    subprotocol = None
+    scheme, _, credentials = websocket.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() == "bearer":
+        token = credentials
+    else:
+        subprotocols = websocket.scope.get("subprotocols", [])
+        if len(subprotocols) == 2 and subprotocols[0] == "bearer":
+            subprotocol, token = subprotocols
+
+    me_id = None
+    async with db.get() as session:
+        if token:
+            me_id = await session_user_id(session, token)
+        if me_id is not None and not await group_open_dms(session, me_id, group_id):
+            me_id = None
+        await session.commit()
+
+    if me_id is None:
+        await websocket.close(code=1008)
+        return
+    if live_connections_full():
+        await websocket.close(code=1013)
+        return
+
+    await websocket.accept(subprotocol=subprotocol)
+
+    async def receive() -> None:
+        while True:
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+
+            # Binary frames are read as UTF-8 JSON just like text frames.
+            data = frame.get("text")
+            if data is None:
+                data = frame.get("bytes", b"")
+
+            try:
+                req = ChatWebSocketRequest.model_validate_json(data)
+            except ValidationError as e:
+                await websocket.send_json(dict(type="error", detail=str(e)))
+                continue
+
+            try:
+                async with db.get() as session:
+                    response = await post_chat_message(
+                        session, me_id, group_id, req.content
+                    )
+            except HTTPException as e:
+                await websocket.send_json(
+                    dict(type="error", nonce=req.nonce, detail=e.detail)
+                )
+                continue
+
+            reply = ChatWebSocketReply(type="sent", nonce=req.nonce, message=response)
+            await websocket.send_text(reply.model_dump_json())
+
+    async def forward() -> None:
+        async with aclosing(live_chat(group_id, me_id, after_id)) as messages:
+            async for message in messages:
+                await websocket.send_text(message.frame)
+        # The subscription was dropped for falling behind.
+        await websocket.close(code=1013)
+
+    tasks = [asyncio.create_task(receive()), asyncio.create_task(forward())]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if not isinstance(task.exception(), WebSocketDisconnect):
+                task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Wait for the tasks to finish cleaning up, such as unsubscribing.
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def live_connections_full() -> bool:
+    """
+    This function returns True if this process cannot take any more live
+    streams or WebSockets.
+    """
+    return broadcast.stats.subscribers >= MAX_LIVE_CONNECTIONS
+
+
+@router.get("/chat/live/stats")
+async def live_chat_stats(_: int = Depends(authorize)) -> BroadcastStats:
+    """
+    This function returns the live chat counters of this server process.
+    """
+    return broadcast.stats
+
+
+# REPLAY_BATCH_SIZE is how many missed messages are loaded at once when
+# replaying them to a reconnecting live stream.
+REPLAY_BATCH_SIZE = 100
+
+
+@dataclass
+class EncodedChatMessage:
+    """
+    EncodedChatMessage is a chat message as seen by one viewer, encoded for
+    every live transport.
+    """
+
+    id: int
+    # event is the server-sent event of the message.
+    event: bytes
+    # frame is the WebSocket frame of the message.
+    frame: str
+
+    @staticmethod
+    def of(id: int, data: str) -> "EncodedChatMessage":
+        """
+        This function encodes a message given its ChatMessageResponse JSON.
+        """
+        return EncodedChatMessage(
+            id=id,
+            event=ServerSentEvent(id=str(id), data=data).encode(),
+            frame=f'{{"type": "message", "message": {data}}}',
+        )
+
+
+@dataclass
+class ChatEnvelope:
+    """
+    ChatEnvelope is a chat message as it is broadcast to live streams. The
+    message is encoded for every access level that its author can be viewed
+    at, so that subscribers only pick one.
+    """
+
+    id: int
+    author_id: int
+    author_group_id: Optional[int]
+    messages: dict[AccessLevel, EncodedChatMessage]
+
+
+def encode_chat_envelope(
+    message: ChatMessage,
+    author: User,
+    responses: dict[AccessLevel, ChatMessageResponse],
+) -> str:
+    """
+    This function encodes the responses of a message, one per access level, as
+    a broadcast message. Broadcast messages must be strings to cross processes.
+    """
+    return json.dumps(
+        dict(
+            id=message.id,
+            author_id=author.id,
+            author_group_id=author.group_id,
+            data={
+                int(level): response.model_dump_json()
+                for level, response in responses.items()
+            },
+        )
+    )
+
+
+@functools.lru_cache(maxsize=256)
+def decode_chat_envelope(message: str) -> ChatEnvelope:
+    """
+    This function decodes a broadcast message made by encode_chat_envelope.
+    Every subscriber in the process receives the same string, so it is only
+    decoded once.
+    """
+    envelope = json.loads(message)
+    return ChatEnvelope(
+        id=envelope["id"],
+        author_id=envelope["author_id"],
+        author_group_id=envelope["author_group_id"],
+        messages={
+            AccessLevel(int(level)): EncodedChatMessage.of(envelope["id"], data)
+            for level, data in envelope["data"].items()
+        },
+    )
+
+
+async def live_chat_events(
+    group_id: int,
+    me_id: int,
+    last_event_id: Optional[int],
+) -> AsyncIterator[bytes]:
+    """
+    This function yields the server-sent events of a live chat stream.
+    """
+    async for message in live_chat(group_id, me_id, last_event_id):
+        yield message.event
+
+
+async def live_chat(
+    group_id: int,
+    me_id: int,
+    after_id: Optional[int],
+) -> AsyncGenerator[EncodedChatMessage, None]:
+    """
+    This function yields the messages sent to a group as the current user sees
+    them. Messages after after_id are replayed from the database before live
+    delivery starts. It ends if the subscription is dropped for falling behind.
+    """
+    # The stream outlives the request's database session, so every lookup here
+    # uses its own.
+    async with broadcast.subscribe(channel=str(group_id)) as subscriber:
+        # Subscribing before replaying means that no message can fall between
+        # the two. Messages that show up in both are only sent once.
+        replayed: set[int] = set()
+        if after_id is not None:
+            async for response in chat_messages_after(group_id, me_id, after_id):
+                replayed.add(response.id)
+                yield EncodedChatMessage.of(response.id, response.model_dump_json())
+
+        async for event in subscriber:
+            envelope = decode_chat_envelope(event.message)
+            if envelope.id in replayed:
+                continue
+
+            # This is answered from the access cache unless it went stale.
+            async with db.get() as session:
+                level = await user_level(
+                    session,
+                    me_id,
+                    envelope.author_id,
+                    envelope.author_group_id,
+                )
+            yield envelope.messages[level]
+
+
+async def chat_messages_after(
+    group_id: int,
+    me_id: int,
+    after_id: int,
+) -> AsyncIterator[ChatMessageResponse]:
+    """
+    This function yields every message of a group after the given message ID,
+    oldest first.
+    """
+    while True:
+        async with db.get() as session:
+            messages = (
+                await session.exec(
+                    select(ChatMessage)
+                    .where(ChatMessage.group_id == group_id, ChatMessage.id > after_id)
+                    .order_by(col(ChatMessage.id).asc())
+                    .limit(REPLAY_BATCH_SIZE)
+                )
+            ).all()
+            responses = await chat_message_responses(session, me_id, messages)
+
+        for response in responses:
+            yield response
+
+        if len(messages) < REPLAY_BATCH_SIZE:
+            return
+        after_id = messages[-1].id
 
 
 async def assert_asset_hash(db: Database, hash: str):
@@ -1,11 +1,19 @@
 from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel
-from sqlmodel import select
-from viewlevels.group import assert_group_level, assert_owns_group, group_level
-from db import Database
+from sqlmodel import select, col
+from viewlevels.group import (
+    assert_group_level,
+    assert_owns_group,
+    group_levels,
+    invalidate_group_access,
+)
+from db import Database, Loader
 from db.models import *
+from db import spatial
 from utils.sessions import authorize
-from viewlevels.user import UserView, user_view_from_db
+from viewlevels.user import UserView, user_views
+from collections import defaultdict
+from typing import Sequence
 import db
 
 router = APIRouter(tags=["groups"])
@@ -26,21 +34,48 @@ class GroupResponse(BaseModel):
 
 
 async def group_response(db: Database, me_id: int, group: Group) -> GroupResponse:
-    people = (await db.exec(select(User).where(User.group_id == group.id))).all()
-    people = [await user_view_from_db(db, me_id, person.id) for person in people]
-    level = await group_level(db, me_id, group.id)
-    return GroupResponse(
-        **group.model_dump(),
-        people=people,
-        interested=level >= AccessLevel.LEVEL1,
-        access_level=level,
-    )
+    return (await group_responses(db, me_id, [group]))[0]
+
+
+async def group_responses(
+    db: Database,
+    me_id: int,
+    groups: Sequence[Group],
+) -> list[GroupResponse]:
+    """
+    This function builds the GroupResponse of every given group. The members,
+    their photos and the current user's access levels are loaded for all groups
+    at once, so the number of queries does not grow with the number of groups.
+    """
+    group_ids = [group.id for group in groups]
+    levels = await group_levels(db, me_id, group_ids)
+
+    people = (
+        await db.exec(select(User).where(col(User.group_id).in_(group_ids)))
+    ).all()
+    views = await user_views(db, me_id, people)
+
+    people_by_group: dict[int, list[UserView]] = defaultdict(list)
+    for person in people:
+        assert person.group_id is not None
+        people_by_group[person.group_id].append(views[person.id])
+
+    return [
+        GroupResponse(
+            **group.model_dump(),
+            people=people_by_group[group.id],
+            interested=levels[group.id] >= AccessLevel.LEVEL1,
+            access_level=levels[group.id],
+        )
+        for group in groups
+    ]
 
 
 @router.get("/groups/{group_id}")
 async def get_group(
     group_id: int,
     db: Database = Depends(db.use),
+    loader: Loader = Depends(db.use_loader),
     me_id: int = Depends(authorize),
 ) -> GroupResponse:
     """
@@ -48,8 +83,7 @@ async def get_group(
     """
 
     # TODO: implement permission checking
-    query = select(Group).where(Group.id == group_id)
-    group = (await db.exec(query)).first()
+    group = await loader.get(Group, group_id)
     if group is None:
         raise HTTPException(status_code=404, detail="Group not found")
 
@@ -68,7 +102,7 @@ async def get_group_people(
     """
     await assert_group_level(db, me_id, group_id, AccessLevel.LEVEL1)
     people = (await db.exec(select(User).where(User.group_id == group_id))).all()
-    return [await user_view_from_db(db, me_id, person.id) for person in people]
+    return list((await user_views(db, me_id, people)).values())
 
 
 class CreateGroupRequest(BaseModel):
@@ -85,6 +119,7 @@ class CreateGroupRequest(BaseModel):
 async def create_group(
     req: CreateGroupRequest,
     db: Database = Depends(db.use),
+    loader: Loader = Depends(db.use_loader),
     me_id: int = Depends(authorize),
 ) -> GroupResponse:
     """
@@ -92,7 +127,8 @@ async def create_group(
     """
     # TODO: implement permissions checking
 
-    user = (await db.exec(select(User).where(User.id == me_id))).one()
+    user = await loader.get(User, me_id)
+    assert user is not None
     if user.group_id is not None:
         raise HTTPException(
             status_code=400,
@@ -108,6 +144,8 @@ async def create_group(
         db.add(group)
         db.add(user)
 
+    invalidate_group_access(db, group.id, me_id)
+    await spatial.index_group(db, group)
     return await group_response(db, me_id, group)
 
 
@@ -124,6 +162,8 @@ async def delete_group(
     query = select(Group).where(Group.id == group_id)
     group = (await db.exec(query)).one()
     await assert_owns_group(db, me_id, group.id)
+    await spatial.unindex_group(db, group.id)
+    invalidate_group_access(db, group.id)
     await db.delete(group)
     await db.commit()
     return group
@@ -146,6 +186,7 @@ async def update_group(
     for k, v in req.model_dump().items():
         setattr(group, k, v)
     db.add(group)
+    await spatial.index_group(db, group)
     await db.commit()
     await db.refresh(group)
     return group
@@ -174,6 +215,7 @@ async def group_interested(
         level=AccessLevel.LEVEL1,
     )
     db.add(group_relationship)
+    invalidate_group_access(db, group_id, me_id)
 
 
 @router.post("/groups/{group_id}/trust")
@@ -206,3 +248,4 @@ async def group_trust(
 
     relationship.level = AccessLevel.LEVEL2
     db.add(relationship)
+    invalidate_group_access(db, group_id, relationship.user_id)
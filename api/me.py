@@ -3,7 +3,7 @@ from pydantic import BaseModel
 from sqlmodel import select
 from utils.sessions import authorize, hash_password, verify_password, new_session
 from api.assets import assert_asset_hash
-from db import Database
+from db import Database, Loader
 from db.models import *
 import db
 
@@ -93,17 +93,18 @@ class MeResponse(BaseModel):
 
 @router.get("/users/me")
 async def get_self(
-    db: Database = Depends(db.use),
+    loader: Loader = Depends(db.use_loader),
     me_id: int = Depends(authorize),
 ) -> MeResponse:
     """
     This function returns the currently authenticated user.
     """
-    user = (await db.exec(select(User).where(User.id == me_id))).one()
+    user = await loader.get(User, me_id)
+    assert user is not None
     group = None
 
     if user.group_id is not None:
-        group = (await db.exec(select(Group).where(Group.id == user.group_id))).one()
+        group = await loader.get(Group, user.group_id)
 
     return MeResponse(**user.model_dump(), group=group)
 
@@ -1,14 +1,19 @@
 from dataclasses import dataclass
-from typing import Annotated, AsyncGenerator, Optional
+from typing import Annotated, Optional
 from fastapi import APIRouter, Depends, Form, HTTPException, Query
-from sqlmodel import select
-from haversine import haversine as calculate_distance, Unit as DistanceUnit
-from api.groups import GroupResponse, group_response
+from pydantic import BaseModel
+from fastapi_pagination.cursor import CursorPage, CursorParams, decode_cursor
+from sqlmodel import select, col, or_, and_, not_
+from haversine import Unit as DistanceUnit
+from api.groups import GroupResponse, group_responses
 from db import Database
 from db.models import *
+from db import spatial
 from utils.sessions import authorize
+from utils import geo
 import db
-import heapq
+import math
+import numpy as np
 
 
 router = APIRouter(tags=["search"])
@@ -31,29 +36,203 @@ class SearchParams:
     )
 
 
+@dataclass
+class SearchPageParams(SearchParams):
+    limit: int = Query(100, ge=1, description="Maximum number of groups to return")
+    cursor: Optional[str] = Query(
+        None,
+        description="Cursor for the next page, as returned by the previous page",
+    )
+
+
+# SearchCursor is the (distance, group ID) of the last group of a page.
+SearchCursor = tuple[float, int]
+
+
+def encode_search_cursor(distance: float, group_id: int) -> str:
+    return f"{distance!r}:{group_id}"
+
+
+def decode_search_cursor(cursor: Optional[str]) -> Optional[SearchCursor]:
+    raw = decode_cursor(cursor)
+    if raw is None:
+        return None
+
+    try:
+        distance, group_id = raw.split(":")
+        return float(distance), int(group_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor value")
+
+
 async def search_nearest_groups(
     db: Database,
     params: SearchParams,
+    after: Optional[SearchCursor] = None,
 ) -> list[tuple[Group, float]]:
-    group_distances = [group async for group in generate_group_distances(db, params)]
-    return heapq.nsmallest(params.limit, group_distances, key=lambda x: x[1])
+    """
+    This function returns the groups nearest to the search point, ordered by
+    distance and then by ID. If after is given, the search resumes right after
+    that group.
+    """
+    radius = params.radius
+    inner = None
+    if after is not None:
+        # The groups within the cursor's distance were already returned. Start
+        # with about as much area again, which should hold about a page's
+        # worth of groups, and widen the search until the page is full.
+        after_distance, _ = after
+        radius = min(
+            params.radius,
+            max(after_distance * math.sqrt(2), params.radius / 8),
+        )
+        inner = geo.inner_box(params.lat, params.lon, after_distance, params.unit)
 
+    while True:
+        ids, lats, lons = await search_group_locations(db, params, radius, inner)
+        indices, distances = geo.nearest(
+            params.lat,
+            params.lon,
+            lats,
+            lons,
+            ids,
+            radius=radius,
+            limit=params.limit,
+            unit=params.unit,
+            after=after,
+        )
+        if len(indices) >= params.limit or radius >= params.radius:
+            break
+
+        # Only resumed searches start with less than the full radius.
+        assert after is not None
+        after_distance, _ = after
+        radius = min(params.radius, after_distance + 2 * (radius - after_distance))
+
+    # Only load the full rows of the groups that actually made it into the
+    # page.
+    nearest_ids = ids[indices].tolist()
+    groups = [
+        group
+        for group in (
+            await db.exec(select(Group).where(col(Group.id).in_(nearest_ids)))
+        ).all()
+        if params.has_house is None or group.has_house == params.has_house
+    ]
 
-async def generate_group_distances(
+    # The candidates may come from a cache that writes made by other server
+    # processes did not invalidate. The loaded rows are ranked again, which
+    # drops groups that were deleted or moved out of the search.
+    indices, distances = geo.nearest(
+        params.lat,
+        params.lon,
+        np.array([group.lat for group in groups], np.float64),
+        np.array([group.lon for group in groups], np.float64),
+        np.array([group.id for group in groups], np.int64),
+        radius=params.radius,
+        limit=params.limit,
+        unit=params.unit,
+        after=after,
+    )
+    return [(groups[i], float(d)) for i, d in zip(indices.tolist(), distances)]
+
+
+# Searches are cached around their point snapped to a grid with this spacing in
+# degrees, which is roughly a kilometer.
+SEARCH_CACHE_GRID = 0.01
+
+
+async def search_group_locations(
     db: Database,
     params: SearchParams,
-) -> AsyncGenerator[tuple[Group, float], None]:
-    query = select(Group).where(
-        (Group.has_house == params.has_house if params.has_house is not None else True)
+    radius: float,
+    exclude: Optional[geo.BoundingBox] = None,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    This function returns the IDs, latitudes and longitudes of the groups that
+    may lie within the radius of the search point, skipping the ones inside of
+    the exclude box.
+
+    Searches without an exclude box are served from spatial.location_cache.
+    The search point is snapped to SEARCH_CACHE_GRID and the radius is rounded
+    up, so that nearby searches share an entry. Each entry is loaded for a
+    slightly larger radius that covers every search sharing it, and callers
+    must check the exact distances anyway.
+    """
+    if exclude is not None:
+        boxes = geo.bounding_boxes(params.lat, params.lon, radius, params.unit)
+        return await query_group_locations(db, boxes, params.has_house, exclude)
+
+    lat = round(params.lat / SEARCH_CACHE_GRID) * SEARCH_CACHE_GRID
+    lon = round(params.lon / SEARCH_CACHE_GRID) * SEARCH_CACHE_GRID
+    bucket = 2 ** (math.ceil(2 * math.log2(radius)) / 2) if radius > 0 else 0.0
+    key = ("search", lat, lon, bucket, params.has_house, params.unit)
+
+    cached = spatial.location_cache.get(key)
+    if cached is None:
+        cache_radius = bucket + geo.snap_distance(SEARCH_CACHE_GRID, params.unit)
+        boxes = geo.bounding_boxes(lat, lon, cache_radius, params.unit)
+        ids, lats, lons = await query_group_locations(db, boxes, params.has_house)
+
+        cached = spatial.CachedLocations(boxes, ids, lats, lons)
+        spatial.location_cache.set(key, cached)
+
+    return cached.ids, cached.lats, cached.lons
+
+
+async def query_group_locations(
+    db: Database,
+    boxes: list[geo.BoundingBox],
+    has_house: Optional[bool],
+    exclude: Optional[geo.BoundingBox] = None,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    query = select(Group.id, Group.lat, Group.lon).where(
+        col(Group.id).in_(spatial.locate(boxes)),
+        or_(
+            *[
+                and_(
+                    Group.lat >= box.min_lat,
+                    Group.lat <= box.max_lat,
+                    Group.lon >= box.min_lon,
+                    Group.lon <= box.max_lon,
+                )
+                for box in boxes
+            ]
+        ),
+        (Group.has_house == has_house if has_house is not None else True),
+        (
+            not_(
+                and_(
+                    Group.lat > exclude.min_lat,
+                    Group.lat < exclude.max_lat,
+                    Group.lon > exclude.min_lon,
+                    Group.lon < exclude.max_lon,
+                )
+            )
+            if exclude is not None
+            else True
+        ),
     )
-    for group in await db.exec(query):
-        distance = calculate_distance(
-            (params.lat, params.lon),
-            (group.lat, group.lon),
-            unit=params.unit,
-        )
-        if distance <= params.radius:
-            yield group, distance
+    candidates = (await db.exec(query)).all()
+
+    ids = np.fromiter((id for id, _, _ in candidates), np.int64, len(candidates))
+    lats = np.fromiter((lat for _, lat, _ in candidates), np.float64, len(candidates))
+    lons = np.fromiter((lon for _, _, lon in candidates), np.float64, len(candidates))
+    return ids, lats, lons
+
+
+async def searched_groups(
+    db: Database,
+    me_id: int,
+    group_distances: list[tuple[Group, float]],
+) -> list[SearchedGroup]:
+    responses = await group_responses(
+        db, me_id, [group for group, _ in group_distances]
+    )
+    return [
+        SearchedGroup(**group.model_dump(), distance=distance)
+        for group, (_, distance) in zip(responses, group_distances)
+    ]
 
 
 @router.get("/search")
@@ -66,11 +245,93 @@ async def search_groups(
     Searches for groups within an given radius from an certain lat and lon point.
     """
     group_distances = await search_nearest_groups(db, params)
-    group_responses = [
-        (await group_response(group=group, me_id=me_id, db=db), distance)
-        for group, distance in group_distances
-    ]
+    return await searched_groups(db, me_id, group_distances)
+
+
+@router.get("/search/page")
+async def search_groups_page(
+    params: SearchPageParams = Depends(),
+    db: Database = Depends(db.use),
+    me_id: int = Depends(authorize),
+) -> CursorPage[SearchedGroup]:
+    """
+    Searches for groups like /search, but one page at a time. Pass the
+    next_page cursor of a page along with the same search parameters to fetch
+    the page after it.
+    """
+    after = decode_search_cursor(params.cursor)
+    group_distances = await search_nearest_groups(db, params, after)
+
+    next_page = None
+    if params.limit > 0 and len(group_distances) == params.limit:
+        last, distance = group_distances[-1]
+        next_page = encode_search_cursor(distance, last.id)
+
+    return CursorPage[SearchedGroup].create(
+        await searched_groups(db, me_id, group_distances),
+        CursorParams(cursor=params.cursor, size=params.limit),
+        current=decode_cursor(params.cursor),
+        next_=next_page,
+    )
+
+
+@dataclass
+class ClusterParams:
+    min_lat: float = Query(description="Southern edge of the visible map")
+    min_lon: float = Query(description="Western edge of the visible map")
+    max_lat: float = Query(description="Northern edge of the visible map")
+    max_lon: float = Query(description="Eastern edge of the visible map")
+    zoom: int = Query(ge=0, description="Zoom level of the visible map")
+
+
+class SearchedCluster(BaseModel):
+    lat: float
+    lon: float
+    count: int
+    has_house_count: int
+
+
+# CLUSTER_ZOOM_OFFSET is how many levels finer than the map's own tiles the
+# clusters are, so that each map tile is split into 8x8 clusters.
+CLUSTER_ZOOM_OFFSET = 3
+
+
+@router.get("/search/clusters")
+async def search_clusters(
+    params: ClusterParams = Depends(),
+    db: Database = Depends(db.use),
+    _=Depends(authorize),
+) -> list[SearchedCluster]:
+    """
+    Returns the groups within the visible map as clusters, each with its group
+    count and centroid. Use this instead of /search for zoomed-out maps.
+    A map crossing the antimeridian has a min_lon greater than its max_lon.
+    """
+    zoom = min(params.zoom + CLUSTER_ZOOM_OFFSET, spatial.MAX_CLUSTER_ZOOM)
+
+    lon_ranges = [(params.min_lon, params.max_lon)]
+    if params.min_lon > params.max_lon:
+        lon_ranges = [(params.min_lon, 180), (-180, params.max_lon)]
+
+    clusters: list[GroupCluster] = []
+    for min_lon, max_lon in lon_ranges:
+        min_x, min_y = geo.tile(params.max_lat, min_lon, zoom)
+        max_x, max_y = geo.tile(params.min_lat, max_lon, zoom)
+        query = select(GroupCluster).where(
+            GroupCluster.zoom == zoom,
+            GroupCluster.x >= min_x,
+            GroupCluster.x <= max_x,
+            GroupCluster.y >= min_y,
+            GroupCluster.y <= max_y,
+        )
+        clusters.extend((await db.exec(query)).all())
+
     return [
-        SearchedGroup(**group.model_dump(), distance=distance)
-        for group, distance in group_responses
+        SearchedCluster(
+            lat=cluster.lat_sum / cluster.count,
+            lon=cluster.lon_sum / cluster.count,
+            count=cluster.count,
+            has_house_count=cluster.houses,
+        )
+        for cluster in clusters
     ]
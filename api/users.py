@@ -1,9 +1,9 @@
 from fastapi import APIRouter, Depends, HTTPException
 from sqlmodel import select
-from db import Database
+from db import Database, Loader
 from db.models import User, GroupRelationship, AccessLevel
 from utils.sessions import authorize
-from viewlevels.group import assert_group_level
+from viewlevels.group import assert_group_level, invalidate_group_access
 from viewlevels.user import UserView, user_view_from_db
 import db
 
@@ -14,6 +14,7 @@ router = APIRouter(tags=["users"])
 async def get_user(
     user_id: int,
     db: Database = Depends(db.use),
+    loader: Loader = Depends(db.use_loader),
     me_id: int = Depends(authorize),
 ) -> UserView:
     """
@@ -21,15 +22,14 @@ async def get_user(
     It only allows access if the user has expressed interest in your group via
     `/groups/:id/interested`.
     """
-    me = (await db.exec(select(User).where(User.id == me_id))).one()
-    if me.group_id is None:
+    me = await loader.get(User, me_id)
+    if me is None or me.group_id is None:
         raise HTTPException(status_code=403, detail="You do not have a group")
 
     # Ensure that the user has expressed interest in your group.
     await assert_group_level(db, user_id, me.group_id, AccessLevel.LEVEL1)
 
-    user = (await db.exec(select(User).where(User.id == user_id))).one()
-    return await user_view_from_db(db, me_id, user.id)
+    return await user_view_from_db(db, me_id, user_id)
 
 
 # The user id is the other person'd id
@@ -64,3 +64,4 @@ async def accept_group(
     relationship.user_id = user_id
     relationship.open_dms = True
     db.add(relationship)
+    invalidate_group_access(db, relationship.group_id, user_id)
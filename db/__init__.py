@@ -1,4 +1,4 @@
-from fastapi import HTTPException
+from fastapi import Depends, HTTPException
 import sqlalchemy
 import sqlalchemy.engine
 import sqlalchemy.exc
@@ -11,6 +11,13 @@ import pydantic.json
 from typing import AsyncGenerator
 
 from . import models  # type: ignore
+from . import blobs
+from . import fts
+from . import inbox
+from . import spatial
+from .batch import InsertBatcher
+from .events import on_commit, on_transaction_end
+from .loader import Loader
 
 Database = sqlmodel.ext.asyncio.session.AsyncSession
 
@@ -59,6 +66,21 @@ async def init_db() -> None:
 
     async with _engine.begin() as conn:
         await conn.run_sync(sqlmodel.SQLModel.metadata.create_all)
+        await conn.run_sync(_create_missing_indexes)
+        await conn.run_sync(spatial.create_index)
+        await conn.run_sync(inbox.create_state)
+        await conn.run_sync(fts.create_index)
+        await blobs.move_assets(conn)
+
+
+def _create_missing_indexes(conn: sqlalchemy.engine.Connection) -> None:
+    """
+    create_all only creates indexes together with their table, so an index
+    that is added to an existing table would otherwise never be created.
+    """
+    for table in sqlmodel.SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
 
 
 @sqlalchemy.event.listens_for(sqlalchemy.engine.Engine, "connect")
@@ -69,14 +91,18 @@ def set_sqlite_pragma(conn, _):
     cursor.close()
 
 
-def get() -> Database:
+def get(expire_on_commit: bool = True) -> Database:
     """
-    This function returns a new database session.
+    This function returns a new database session. If expire_on_commit is False,
+    rows can still be read after they are committed without loading them again.
     """
     if _engine is None:
         raise Exception("must call db.init() before using the database")
 
-    return sqlmodel.ext.asyncio.session.AsyncSession(_engine)
+    return sqlmodel.ext.asyncio.session.AsyncSession(
+        _engine,
+        expire_on_commit=expire_on_commit,
+    )
 
 
 # For async info on SQLModel, see
@@ -95,3 +121,12 @@ async def use() -> AsyncGenerator[Database, None]:
         except:
             await session.rollback()
             raise
+
+
+async def use_loader(db: Database = Depends(use)) -> Loader:
+    """
+    This function returns the Loader of the request's database session.
+    Use this in FastAPI route functions next to db.use to look up rows by
+    primary key.
+    """
+    return Loader.of(db)
@@ -0,0 +1,97 @@
+from datetime import timedelta
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+from typing import Awaitable, Callable, Generic, Optional, Sequence, TypeVar
+import asyncio
+
+T = TypeVar("T", bound=SQLModel)
+
+
+class InsertBatcher(Generic[T]):
+    """
+    InsertBatcher inserts rows for concurrent callers in shared transactions.
+    Committing is bound by the disk's sync rate, so committing many rows at
+    once lets far more rows through than committing each on its own.
+
+    A row waits at most max_delay for others to join its transaction, unless
+    max_size rows are already waiting. Transactions are committed one at a
+    time, which is what SQLite does anyway.
+
+    Rows are inserted in sessions made by new_session, which must not expire
+    rows on commit so that callers can still read them. If before_commit is
+    given, it is called with the session and the rows of every transaction
+    right before it is committed.
+    """
+
+    def __init__(
+        self,
+        new_session: Callable[[], AsyncSession],
+        max_delay: timedelta,
+        max_size: int,
+        before_commit: Optional[
+            Callable[[AsyncSession, Sequence[T]], Awaitable[None]]
+        ] = None,
+    ):
+        self._new_session = new_session
+        self._before_commit = before_commit
+        self.max_delay = max_delay.total_seconds()
+        self.max_size = max_size
+
+        self._pending: list[tuple[T, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushes: set[asyncio.Task] = set()
+        self._lock = asyncio.Lock()
+
+    async def insert(self, row: T) -> T:
+        """
+        This function inserts the row and returns it once it is committed. If
+        the row cannot be inserted, the database error is raised.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((row, future))
+
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                self.max_delay, self._flush
+            )
+
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._commit(batch))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    async def _commit(self, batch: list[tuple[T, asyncio.Future]]) -> None:
+        async with self._lock:
+            try:
+                async with self._new_session() as session:
+                    rows = [row for row, _ in batch]
+                    session.add_all(rows)
+                    if self._before_commit is not None:
+                        await session.flush()
+                        await self._before_commit(session, rows)
+                    await session.commit()
+            except Exception as e:
+                if len(batch) == 1:
+                    _, future = batch[0]
+                    if not future.done():
+                        future.set_exception(e)
+                    return
+            else:
+                for row, future in batch:
+                    if not future.done():
+                        future.set_result(row)
+                return
+
+        # One bad row must not fail the others, so retry them one by one.
+        for entry in batch:
+            await self._commit([entry])
@@ -0,0 +1,283 @@
+from abc import ABC, abstractmethod
+from sqlalchemy import bindparam, text
+from sqlalchemy.ext.asyncio import AsyncConnection
+from typing import BinaryIO, Optional
+from utils.assetutil import encode_hash
+import asyncio
+import base64
+import binascii
+import hashlib
+import os
+import tempfile
+
+
+class BlobStore(ABC):
+    """
+    BlobStore stores the data of assets, keyed by their hash. Only the metadata
+    of assets is kept in the database.
+    """
+
+    @abstractmethod
+    async def put(self, hash: str, data: bytes) -> None:
+        """
+        This function stores the data under the given hash. Storing data that
+        is already stored does nothing.
+        """
+
+    @abstractmethod
+    async def get(self, hash: str) -> Optional[bytes]:
+        """
+        This function returns the data stored under the given hash, or None if
+        there is none.
+        """
+
+    @abstractmethod
+    async def exists(self, hash: str) -> bool:
+        """
+        This function returns True if data is stored under the given hash.
+        """
+
+    def writer(self) -> "BlobWriter":
+        """
+        This function returns a BlobWriter for storing a blob whose hash is not
+        known yet.
+        """
+        return BlobWriter(self)
+
+    def path(self, hash: str) -> Optional[str]:
+        """
+        This function returns the path of the local file that the blob with
+        the given hash is stored in, so that it can be sent straight from the
+        file. It returns None if the store does not keep blobs in local files
+        or if the hash is not valid.
+        """
+        return None
+
+
+class BlobWriter:
+    """
+    BlobWriter stores a blob that arrives in chunks, hashing it as it goes, so
+    that its hash is known once the last chunk is written. Nothing is stored
+    until commit is called.
+
+    This BlobWriter keeps the chunks in memory. Stores that can do better
+    return their own from BlobStore.writer.
+    """
+
+    def __init__(self, store: BlobStore):
+        self.store = store
+        self.size = 0
+        self._hasher = hashlib.sha256()
+        self._chunks: list[bytes] = []
+
+    async def __aenter__(self) -> "BlobWriter":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.discard()
+
+    async def write(self, data: bytes) -> None:
+        """
+        This function appends the data to the blob.
+        """
+        self.size += len(data)
+        await asyncio.to_thread(self._hasher.update, data)
+        self._chunks.append(data)
+
+    async def commit(self) -> str:
+        """
+        This function stores the blob under its hash and returns the hash.
+        """
+        hash = encode_hash(self._hasher.digest())
+        await self.store.put(hash, b"".join(self._chunks))
+        self._chunks = []
+        return hash
+
+    async def discard(self) -> None:
+        """
+        This function throws away whatever was written and not committed.
+        """
+        self._chunks = []
+
+
+class FileBlobStore(BlobStore):
+    """
+    FileBlobStore stores every blob as a file in a directory, named by its
+    hash and sharded into subdirectories by the first bytes of the hash so
+    that no directory grows too large.
+
+    Hashes are the URL-safe base64 that utils.assetutil.hash_bytes returns, but
+    files are named by their hex form instead. Hex is safe on case-insensitive
+    file systems, and hashes that do not decode never reach the file system.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, hash: str) -> Optional[str]:
+        # The path is returned whether the blob exists or not.
+        try:
+            digest = base64.urlsafe_b64decode(hash.encode())
+        except (binascii.Error, ValueError):
+            return None
+        if len(digest) != 32:
+            return None
+
+        name = digest.hex()
+        return os.path.join(self.root, name[0:2], name[2:4], name)
+
+    async def put(self, hash: str, data: bytes) -> None:
+        await asyncio.to_thread(self._write, hash, data)
+
+    async def get(self, hash: str) -> Optional[bytes]:
+        return await asyncio.to_thread(self._read, hash)
+
+    async def exists(self, hash: str) -> bool:
+        path = self.path(hash)
+        return path is not None and await asyncio.to_thread(os.path.exists, path)
+
+    def writer(self) -> BlobWriter:
+        return FileBlobWriter(self)
+
+    def _read(self, hash: str) -> Optional[bytes]:
+        path = self.path(hash)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write(self, hash: str, data: bytes) -> None:
+        path = self.path(hash)
+        if path is None:
+            raise ValueError(f"invalid asset hash {hash!r}")
+        if os.path.exists(path):
+            return
+
+        # Write to a temporary file first and then move it into place, so that
+        # a blob is either complete or missing, even after a crash.
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        except:
+            os.unlink(tmp)
+            raise
+
+
+class FileBlobWriter(BlobWriter):
+    """
+    FileBlobWriter writes the blob to a temporary file next to the blobs and
+    moves it into place on commit. Writing and hashing happen off the event
+    loop.
+    """
+
+    store: FileBlobStore
+
+    def __init__(self, store: FileBlobStore):
+        super().__init__(store)
+        self._file: Optional[BinaryIO] = None
+        self._tmp: Optional[str] = None
+
+    async def write(self, data: bytes) -> None:
+        self.size += len(data)
+        await asyncio.to_thread(self._write, data)
+
+    def _write(self, data: bytes) -> None:
+        if self._file is None:
+            os.makedirs(self.store.root, exist_ok=True)
+            fd, self._tmp = tempfile.mkstemp(dir=self.store.root, prefix=".tmp-")
+            self._file = os.fdopen(fd, "wb")
+
+        self._hasher.update(data)
+        self._file.write(data)
+
+    async def commit(self) -> str:
+        return await asyncio.to_thread(self._commit)
+
+    def _commit(self) -> str:
+        hash = encode_hash(self._hasher.digest())
+        file, tmp = self._file, self._tmp
+        if file is None or tmp is None:
+            # Nothing was written, so there is no file to move.
+            self.store._write(hash, b"")
+            return hash
+
+        path = self.store.path(hash)
+        assert path is not None
+        if os.path.exists(path):
+            # The blob is already stored, so the copy is thrown away without
+            # waiting for it to reach the disk.
+            file.close()
+            os.unlink(tmp)
+        else:
+            file.flush()
+            os.fsync(file.fileno())
+            file.close()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp, path)
+
+        self._file = None
+        self._tmp = None
+        return hash
+
+    async def discard(self) -> None:
+        if self._file is not None:
+            await asyncio.to_thread(self._discard)
+
+    def _discard(self) -> None:
+        if self._file is not None:
+            self._file.close()
+        if self._tmp is not None:
+            os.unlink(self._tmp)
+        self._file = None
+        self._tmp = None
+
+
+store: BlobStore = FileBlobStore("assets")
+
+
+def set_store(s: BlobStore) -> None:
+    global store
+    store = s
+
+
+# _MIGRATE_BATCH_SIZE is how many assets are moved out of the database at once.
+_MIGRATE_BATCH_SIZE = 64
+
+
+async def move_assets(conn: AsyncConnection) -> None:
+    """
+    This function moves the data of assets that is still kept in the database
+    into the blob store. Assets used to be stored inline, so this covers
+    databases from before the blob store existed.
+    """
+    while True:
+        assets = (
+            await conn.execute(
+                text(
+                    "SELECT hash, data FROM asset WHERE length(data) > 0"
+                    f" LIMIT {_MIGRATE_BATCH_SIZE}"
+                )
+            )
+        ).all()
+        if not assets:
+            return
+
+        for hash, data in assets:
+            await store.put(hash, data)
+
+        # The column cannot be dropped without rebuilding the table, so it is
+        # emptied instead.
+        await conn.execute(
+            text("UPDATE asset SET data = x'' WHERE hash IN :hashes").bindparams(
+                bindparam("hashes", expanding=True)
+            ),
+            dict(hashes=[hash for hash, _ in assets]),
+        )
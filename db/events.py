@@ -0,0 +1,50 @@
+from sqlmodel.ext.asyncio.session import AsyncSession
+from typing import Callable
+import sqlalchemy
+import sqlalchemy.orm
+
+
+def on_commit(db: AsyncSession, callback: Callable[[], None]) -> None:
+    """
+    This function schedules the callback to be called once the session's
+    transaction is committed. Use this for anything that must not observe
+    uncommitted data, such as invalidating in-process caches.
+    The callback is dropped if the transaction is rolled back instead.
+    """
+    db.sync_session.info.setdefault("on_commit", []).append(callback)
+
+
+def on_transaction_end(db: AsyncSession, callback: Callable[[], None]) -> None:
+    """
+    This function schedules the callback to be called once the session's
+    transaction ends, whether it is committed, rolled back or abandoned by
+    closing the session. Use this for dropping in-process cache entries that
+    the transaction may have filled with its own uncommitted data.
+    """
+    db.sync_session.info.setdefault("on_transaction_end", []).append(callback)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "after_commit")
+def _run_on_commit(session: sqlalchemy.orm.Session) -> None:
+    # Releasing a savepoint also counts as a commit, but the outer transaction
+    # may still be rolled back.
+    if session.in_nested_transaction():
+        return
+
+    for callback in session.info.pop("on_commit", []):
+        callback()
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "after_soft_rollback")
+def _drop_on_commit(session: sqlalchemy.orm.Session, previous_transaction) -> None:
+    if previous_transaction.parent is None:
+        session.info.pop("on_commit", None)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "after_transaction_end")
+def _run_on_transaction_end(session: sqlalchemy.orm.Session, transaction) -> None:
+    if transaction.parent is not None:
+        return
+
+    for callback in session.info.pop("on_transaction_end", []):
+        callback()
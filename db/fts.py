@@ -0,0 +1,104 @@
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+from sqlmodel.ext.asyncio.session import AsyncSession
+from typing import Optional, Sequence
+from .models import ChatContentText, ChatMessage
+import re
+
+# chat_message_text is an SQLite FTS5 table indexing the text of every text
+# chat message, with the message ID as its rowid. It is contentless, so it
+# only holds the index and not another copy of the text.
+#
+# The group ID is indexed as a column of its own, so that a search within a
+# group is a single index lookup instead of a filter over every match.
+_CREATE_TABLE = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS chat_message_text"
+    " USING fts5(group_id, markdown, content='',"
+    " tokenize='porter unicode61 remove_diacritics 2')"
+)
+
+
+def create_index(conn: Connection) -> None:
+    """
+    This function creates the full-text index if it does not exist yet, then
+    indexes every text message that is missing from it. The latter covers
+    databases that were created before the index existed.
+    """
+    conn.execute(text(_CREATE_TABLE))
+    conn.execute(
+        text(
+            "INSERT INTO chat_message_text (rowid, group_id, markdown)"
+            " SELECT id, group_id, json_extract(content, '$.markdown')"
+            " FROM chatmessage"
+            " WHERE group_id IS NOT NULL"
+            " AND json_extract(content, '$.type') = 'text'"
+            " AND id NOT IN (SELECT rowid FROM chat_message_text)"
+        )
+    )
+
+
+async def index_messages(db: AsyncSession, messages: Sequence[ChatMessage]) -> None:
+    """
+    This function adds the text of the new messages to the full-text index. It
+    must run in the same transaction that inserts the messages.
+    """
+    rows = [
+        dict(
+            id=message.id,
+            group_id=str(message.group_id),
+            markdown=message.content.markdown,
+        )
+        for message in messages
+        if message.group_id is not None and isinstance(message.content, ChatContentText)
+    ]
+    if rows:
+        await db.exec(
+            text(
+                "INSERT INTO chat_message_text (rowid, group_id, markdown)"
+                " VALUES (:id, :group_id, :markdown)"
+            ),  # type: ignore
+            params=rows,  # type: ignore
+        )
+
+
+def _match_query(group_id: int, query: str) -> Optional[str]:
+    # User input is never passed through as FTS5 syntax. Every word becomes a
+    # quoted phrase that must appear in the text, and the last one may also be
+    # the start of a word so that results show up while typing. The words are
+    # limited to the markdown column, or they would also match the group ID.
+    words = re.findall(r"\w+", query)
+    if not words:
+        return None
+
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return f'group_id:"{group_id}" AND markdown:(' + " ".join(terms) + ")"
+
+
+async def search_messages(
+    db: AsyncSession,
+    group_id: int,
+    query: str,
+    limit: int,
+    offset: int = 0,
+) -> list[int]:
+    """
+    This function returns the IDs of the group's text messages that contain
+    every word of the query, best matches first.
+    """
+    match = _match_query(group_id, query)
+    if match is None:
+        return []
+
+    # Only the message text counts towards the rank, since every match has the
+    # same group ID.
+    ids = await db.exec(
+        text(
+            "SELECT rowid FROM chat_message_text"
+            " WHERE chat_message_text MATCH :match"
+            " ORDER BY bm25(chat_message_text, 0.0, 1.0), rowid DESC"
+            " LIMIT :limit OFFSET :offset"
+        ),  # type: ignore
+        params=dict(match=match, limit=limit, offset=offset),
+    )
+    return list(ids.scalars())
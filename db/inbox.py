@@ -0,0 +1,167 @@
+from collections import defaultdict
+from sqlalchemy import func, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Connection
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from typing import Sequence
+from .models import ChatGroupState, ChatMessage, ChatReadCursor
+
+
+def create_state(conn: Connection) -> None:
+    """
+    This function creates the chat state of every group that has messages but
+    no state yet, which covers databases that were created before the state
+    existed.
+
+    Everyone who could read such a group's chat is taken to have read all of
+    its past messages. Otherwise every old message would show up as unread,
+    even to its own author.
+    """
+    conn.execute(
+        text(
+            "WITH backfilled AS ("
+            " SELECT group_id, max(id) AS last_message_id,"
+            " count(*) AS message_count"
+            " FROM chatmessage"
+            ' WHERE group_id IN (SELECT id FROM "group")'
+            " AND group_id NOT IN (SELECT group_id FROM chatgroupstate)"
+            " GROUP BY group_id"
+            "), participant AS ("
+            " SELECT user_id, group_id FROM grouprelationship WHERE open_dms"
+            ' UNION SELECT id, group_id FROM "user" WHERE group_id IS NOT NULL'
+            " UNION SELECT author_id, group_id FROM chatmessage"
+            ' WHERE author_id IN (SELECT id FROM "user")'
+            ")"
+            " INSERT OR IGNORE INTO chatreadcursor"
+            " (user_id, group_id, last_read_id, read_count)"
+            " SELECT participant.user_id, backfilled.group_id,"
+            " backfilled.last_message_id, backfilled.message_count"
+            " FROM backfilled JOIN participant USING (group_id)"
+        )
+    )
+    conn.execute(
+        text(
+            "INSERT INTO chatgroupstate (group_id, last_message_id, message_count)"
+            " SELECT group_id, max(id), count(*) FROM chatmessage"
+            ' WHERE group_id IN (SELECT id FROM "group")'
+            " AND group_id NOT IN (SELECT group_id FROM chatgroupstate)"
+            " GROUP BY group_id"
+        )
+    )
+
+
+async def add_messages(db: AsyncSession, messages: Sequence[ChatMessage]) -> None:
+    """
+    This function updates the chat state of the groups that the new messages
+    were sent to. Authors are taken to have read everything up to their own
+    messages. It must run in the same transaction that inserts the messages.
+    """
+    by_group: dict[int, list[ChatMessage]] = defaultdict(list)
+    for message in messages:
+        if message.group_id is not None:
+            by_group[message.group_id].append(message)
+
+    for group_id, sent in by_group.items():
+        sent.sort(key=lambda message: message.id)
+
+        upsert = sqlite_insert(ChatGroupState).values(
+            group_id=group_id,
+            last_message_id=sent[-1].id,
+            message_count=len(sent),
+        )
+        upsert = upsert.on_conflict_do_update(
+            index_elements=["group_id"],
+            set_=dict(
+                last_message_id=func.max(
+                    ChatGroupState.last_message_id,
+                    upsert.excluded.last_message_id,
+                ),
+                message_count=ChatGroupState.message_count
+                + upsert.excluded.message_count,
+            ),
+        )
+        count = (
+            await db.exec(upsert.returning(ChatGroupState.message_count))  # type: ignore
+        ).scalar_one()
+
+        # Each author has read every message up to their last one here, which
+        # leaves the messages that were sent after it unread.
+        last_sent: dict[int, int] = {}
+        for i, message in enumerate(sent):
+            if message.author_id is not None:
+                last_sent[message.author_id] = i
+
+        await _advance_cursors(
+            db,
+            [
+                dict(
+                    user_id=author_id,
+                    group_id=group_id,
+                    last_read_id=sent[i].id,
+                    read_count=count - (len(sent) - 1 - i),
+                )
+                for author_id, i in last_sent.items()
+            ],
+        )
+
+
+async def mark_read(
+    db: AsyncSession,
+    user_id: int,
+    group_id: int,
+    message_id: int,
+) -> None:
+    """
+    This function marks every message of the group up to the given message as
+    read by the user. Cursors never move backwards.
+    """
+    state = await db.get(ChatGroupState, group_id)
+    if state is None:
+        return
+
+    unread = 0
+    if message_id < state.last_message_id:
+        # Only the messages after the cursor are counted, which are few unless
+        # the user is far behind.
+        unread = (
+            await db.exec(
+                select(func.count()).where(
+                    ChatMessage.group_id == group_id,
+                    ChatMessage.id > message_id,
+                )
+            )
+        ).one()
+
+    await _advance_cursors(
+        db,
+        [
+            dict(
+                user_id=user_id,
+                group_id=group_id,
+                last_read_id=min(message_id, state.last_message_id),
+                read_count=state.message_count - unread,
+            )
+        ],
+    )
+
+
+async def _advance_cursors(db: AsyncSession, cursors: list[dict]) -> None:
+    if not cursors:
+        return
+
+    upsert = sqlite_insert(ChatReadCursor).values(cursors)
+    upsert = upsert.on_conflict_do_update(
+        index_elements=["user_id", "group_id"],
+        set_=dict(
+            last_read_id=func.max(
+                ChatReadCursor.last_read_id,
+                upsert.excluded.last_read_id,
+            ),
+            read_count=func.max(
+                ChatReadCursor.read_count,
+                upsert.excluded.read_count,
+            ),
+        ),
+    )
+    await db.exec(upsert)  # type: ignore
@@ -0,0 +1,126 @@
+from sqlalchemy import inspect, tuple_
+from sqlalchemy.orm.attributes import instance_state
+from sqlmodel import SQLModel, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from typing import Any, Iterable, Optional, TypeVar
+import asyncio
+
+T = TypeVar("T", bound=SQLModel)
+
+
+class Loader:
+    """
+    Loader loads rows by primary key for the duration of one database session,
+    which is one request in route functions.
+
+    Lookups made within the same event loop tick are coalesced into one IN
+    query per table, and loaded rows are remembered so that looking them up
+    again costs no query. Rows that were not found are not remembered, since
+    they may still be created later in the session.
+    """
+
+    def __init__(self, db: AsyncSession):
+        self._db = db
+        self._rows: dict[tuple[type[SQLModel], Any], SQLModel] = {}
+        self._pending: dict[type[SQLModel], dict[Any, asyncio.Future]] = {}
+        self._flush: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def of(db: AsyncSession) -> "Loader":
+        """
+        This function returns the Loader of the given session, creating it if
+        needed.
+        """
+        loader = db.sync_session.info.get("loader")
+        if loader is None:
+            loader = Loader(db)
+            db.sync_session.info["loader"] = loader
+        return loader
+
+    async def get(self, model: type[T], key: Any) -> Optional[T]:
+        """
+        This function returns the row of the model with the given primary key,
+        or None if there is no such row. Composite primary keys are given as
+        tuples.
+        """
+        return (await self.get_many(model, [key])).get(key)
+
+    async def get_many(self, model: type[T], keys: Iterable[Any]) -> dict[Any, T]:
+        """
+        This function returns the rows of the model with the given primary
+        keys, keyed by primary key. Keys without a row are left out.
+        """
+        rows: dict[Any, T] = {}
+        waiting: dict[Any, asyncio.Future] = {}
+
+        for key in keys:
+            row = self._remembered(model, key)
+            if row is not None:
+                rows[key] = row
+                continue
+
+            pending = self._pending.setdefault(model, {})
+            future = pending.get(key)
+            if future is None:
+                future = asyncio.get_running_loop().create_future()
+                pending[key] = future
+            waiting[key] = future
+
+        if waiting and self._flush is None:
+            # Let every other lookup made in this tick join the query.
+            self._flush = asyncio.create_task(self._load_pending())
+
+        for key, future in waiting.items():
+            row = await future
+            if row is not None:
+                rows[key] = row
+
+        return rows
+
+    def _remembered(self, model: type[T], key: Any) -> Optional[T]:
+        row = self._rows.get((model, key))
+        if row is None:
+            return None
+
+        # Rows are expired on commit and cannot be lazily refreshed in async
+        # sessions, so load them again instead.
+        state = instance_state(row)
+        if state.expired_attributes or state.was_deleted:
+            del self._rows[(model, key)]
+            return None
+
+        return row  # type: ignore
+
+    async def _load_pending(self) -> None:
+        try:
+            while self._pending:
+                model, futures = self._pending.popitem()
+                try:
+                    rows = await self._query(model, list(futures))
+                except Exception as e:
+                    for future in futures.values():
+                        future.set_exception(e)
+                    continue
+
+                for key, future in futures.items():
+                    row = rows.get(key)
+                    if row is not None:
+                        self._rows[(model, key)] = row
+                    future.set_result(row)
+        finally:
+            self._flush = None
+
+    async def _query(self, model: type[T], keys: list[Any]) -> dict[Any, T]:
+        mapper = inspect(model)
+        columns = mapper.primary_key
+        names = [mapper.get_property_by_column(column).key for column in columns]
+
+        if len(columns) == 1:
+            where = columns[0].in_(keys)
+        else:
+            where = tuple_(*columns).in_(keys)
+
+        rows = (await self._db.exec(select(model).where(where))).all()
+        if len(names) == 1:
+            return {getattr(row, names[0]): row for row in rows}
+        return {tuple(getattr(row, name) for name in names): row for row in rows}
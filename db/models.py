@@ -2,6 +2,7 @@ from sqlmodel import (
     Field,
     SQLModel,
     Column,
+    Index,
     JSON,
 )
 from pydantic import BaseModel, field_validator
@@ -144,15 +145,39 @@ class Group(SQLModel, table=True):
         return color
 
 
+class GroupCluster(SQLModel, table=True):
+    """
+    A group cluster aggregates all groups within one map tile at one zoom
+    level. Clusters are kept up to date by db.spatial whenever a group is
+    indexed, so that zoomed-out maps never have to look at every group.
+    """
+
+    zoom: int = Field(primary_key=True)
+    x: int = Field(primary_key=True)
+    y: int = Field(primary_key=True)
+
+    count: int = Field(default=0)
+    houses: int = Field(default=0)
+
+    # lat_sum and lon_sum are the sums of the coordinates of all groups in the
+    # cluster, so that the centroid can be computed without looking at them.
+    lat_sum: float = Field(default=0)
+    lon_sum: float = Field(default=0)
+
+
 class Asset(SQLModel, table=True):
     """
     An asset is any arbitrary binary data that can be stored in the database.
     It is identified by the base64-encoded SHA-256 hash of the data.
     Content types are supplied by the server.
+
+    The data itself is kept in db.blobs under the hash.
     """
 
     hash: str = Field(primary_key=True)
-    data: bytes
+    # data is always empty. It used to hold the asset's data, and remains
+    # because older databases require the column.
+    data: bytes = Field(default=b"")
     created_at: datetime = Field(default_factory=datetime.utcnow)
     content_type: str
     alt: str | None = Field(default=None)
@@ -192,6 +217,9 @@ ChatContent = Annotated[
 
 
 class ChatMessage(SQLModel, table=True):
+    # Covers paging through a group's history by message ID.
+    __table_args__ = (Index("ix_chatmessage_group_id_id", "group_id", "id"),)
+
     # id is the unique identifier for the message.
     # It is defined as a Snowflake ID and therefore also contains a timestamp.
     id: int = Field(default_factory=generate_id, primary_key=True)
@@ -209,3 +237,36 @@ class ChatMessage(SQLModel, table=True):
 
     # created_at is the time that the message was created.
     created_at: datetime = Field(default_factory=datetime.utcnow)
+
+
+class ChatGroupState(SQLModel, table=True):
+    """
+    A chat group state summarizes the chat of a group, so that inboxes do not
+    have to look at the messages themselves. It is kept up to date by db.inbox
+    whenever messages are sent.
+    """
+
+    group_id: int = Field(foreign_key="group.id", primary_key=True)
+
+    # last_message_id is the ID of the newest message in the group.
+    last_message_id: int
+
+    # message_count is the number of messages ever sent to the group.
+    message_count: int = 0
+
+
+class ChatReadCursor(SQLModel, table=True):
+    """
+    A chat read cursor records how far a user has read the chat of a group.
+    """
+
+    user_id: int = Field(foreign_key="user.id", primary_key=True)
+    group_id: int = Field(foreign_key="group.id", primary_key=True)
+
+    # last_read_id is the ID of the newest message that the user has read.
+    last_read_id: int
+
+    # read_count is the number of the group's messages that the user has read,
+    # counted like ChatGroupState.message_count. The difference between the
+    # two is the user's unread count.
+    read_count: int = 0
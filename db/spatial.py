@@ -0,0 +1,254 @@
+from sqlalchemy import (
+    Boolean,
+    Column,
+    Float,
+    Integer,
+    MetaData,
+    Table,
+    delete,
+    insert,
+    text,
+    tuple_,
+    union_all,
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from dataclasses import dataclass
+from datetime import timedelta
+from sqlalchemy.engine import Connection
+from sqlmodel import select, col
+from sqlmodel.ext.asyncio.session import AsyncSession
+from typing import Hashable
+from utils.cache import TTLCache
+from utils.geo import BoundingBox, tile
+from .events import on_commit
+from .models import Group, GroupCluster
+import numpy as np
+
+# group_location is an SQLite R*Tree virtual table indexing the position of
+# every group. It lives in its own metadata because SQLModel cannot create
+# virtual tables; see create_index.
+#
+# Each group is stored as a degenerate box (min == max) around its point.
+# R*Tree stores its coordinates as 32-bit floats rounded outwards, so a lookup
+# may return a few groups just outside the requested box. Callers must still
+# check the exact distance.
+#
+# The exact lat, lon and has_house of the group are kept in auxiliary columns,
+# so that the group can be taken back out of its clusters when it changes.
+group_location = Table(
+    "group_location",
+    MetaData(),
+    Column("id", Integer, primary_key=True),
+    Column("min_lat", Float),
+    Column("max_lat", Float),
+    Column("min_lon", Float),
+    Column("max_lon", Float),
+    Column("lat", Float),
+    Column("lon", Float),
+    Column("has_house", Boolean),
+)
+
+# MAX_CLUSTER_ZOOM is the most zoomed-in level that clusters are kept for.
+MAX_CLUSTER_ZOOM = 18
+
+
+@dataclass
+class CachedLocations:
+    """
+    CachedLocations holds the IDs and coordinates of the groups that were found
+    within the given boxes.
+    """
+
+    boxes: list[BoundingBox]
+    ids: np.ndarray
+    lats: np.ndarray
+    lons: np.ndarray
+
+
+# location_cache caches the results of spatial lookups. Its keys are chosen by
+# the caller. An entry is dropped as soon as a group is added to, moved within
+# or removed from any of its boxes.
+location_cache: TTLCache[Hashable, CachedLocations] = TTLCache(
+    maxsize=256,
+    ttl=timedelta(minutes=1),
+)
+
+
+def _invalidate_locations(changed: BoundingBox) -> None:
+    for key, locations in location_cache.items():
+        if any(box.intersects(changed) for box in locations.boxes):
+            location_cache.pop(key)
+
+
+def create_index(conn: Connection) -> None:
+    """
+    This function creates the spatial index if it does not exist yet, then
+    brings it and the group clusters in sync with the group table. The latter
+    covers databases that were created before the index existed.
+    """
+    conn.execute(
+        text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS group_location"
+            " USING rtree(id, min_lat, max_lat, min_lon, max_lon, +lat, +lon, +has_house)"
+        )
+    )
+    removed = conn.execute(
+        text('DELETE FROM group_location WHERE id NOT IN (SELECT id FROM "group")')
+    )
+    added = conn.execute(
+        text(
+            "INSERT INTO group_location"
+            " (id, min_lat, max_lat, min_lon, max_lon, lat, lon, has_house)"
+            ' SELECT id, lat, lat, lon, lon, lat, lon, has_house FROM "group"'
+            " WHERE id NOT IN (SELECT id FROM group_location)"
+        )
+    )
+
+    clustered = conn.execute(
+        select(GroupCluster.count).where(GroupCluster.zoom == 0)
+    ).scalar()
+    indexed = conn.execute(text("SELECT count(*) FROM group_location")).scalar()
+    if removed.rowcount or added.rowcount or (clustered or 0) != indexed:
+        _rebuild_clusters(conn)
+
+
+def _rebuild_clusters(conn: Connection) -> None:
+    clusters: dict[tuple[int, int, int], GroupCluster] = {}
+    locations = conn.execute(
+        select(group_location.c.lat, group_location.c.lon, group_location.c.has_house)
+    )
+    for lat, lon, has_house in locations:
+        for zoom in range(MAX_CLUSTER_ZOOM + 1):
+            x, y = tile(lat, lon, zoom)
+            cluster = clusters.get((zoom, x, y))
+            if cluster is None:
+                cluster = GroupCluster(zoom=zoom, x=x, y=y)
+                clusters[(zoom, x, y)] = cluster
+            cluster.count += 1
+            cluster.houses += int(has_house)
+            cluster.lat_sum += lat
+            cluster.lon_sum += lon
+
+    conn.execute(delete(GroupCluster))
+    if clusters:
+        conn.execute(
+            insert(GroupCluster),
+            [cluster.model_dump() for cluster in clusters.values()],
+        )
+
+
+async def index_group(db: AsyncSession, group: Group) -> None:
+    """
+    This function adds the group to the spatial index and its clusters, or
+    moves it if it is already indexed.
+    """
+    await unindex_group(db, group.id)
+    await db.exec(
+        insert(group_location).values(  # type: ignore
+            id=group.id,
+            min_lat=group.lat,
+            max_lat=group.lat,
+            min_lon=group.lon,
+            max_lon=group.lon,
+            lat=group.lat,
+            lon=group.lon,
+            has_house=group.has_house,
+        )
+    )
+    await _update_clusters(db, group.lat, group.lon, group.has_house, +1)
+
+    changed = BoundingBox(group.lat, group.lon, group.lat, group.lon)
+    on_commit(db, lambda: _invalidate_locations(changed))
+
+
+async def unindex_group(db: AsyncSession, group_id: int) -> None:
+    """
+    This function removes the group from the spatial index and its clusters.
+    """
+    old = (
+        await db.exec(
+            select(
+                group_location.c.lat,
+                group_location.c.lon,
+                group_location.c.has_house,
+            ).where(group_location.c.id == group_id)
+        )
+    ).first()
+    if old is None:
+        return
+
+    lat, lon, has_house = old
+    await db.exec(delete(group_location).where(group_location.c.id == group_id))  # type: ignore
+    await _update_clusters(db, lat, lon, has_house, -1)
+
+    changed = BoundingBox(lat, lon, lat, lon)
+    on_commit(db, lambda: _invalidate_locations(changed))
+
+
+async def _update_clusters(
+    db: AsyncSession,
+    lat: float,
+    lon: float,
+    has_house: bool,
+    sign: int,
+) -> None:
+    """
+    This function adds (sign = +1) or removes (sign = -1) a group at the given
+    point from its cluster at every zoom level.
+    """
+    tiles = [(zoom, *tile(lat, lon, zoom)) for zoom in range(MAX_CLUSTER_ZOOM + 1)]
+
+    upsert = sqlite_insert(GroupCluster).values(
+        [
+            dict(
+                zoom=zoom,
+                x=x,
+                y=y,
+                count=sign,
+                houses=sign * int(has_house),
+                lat_sum=sign * lat,
+                lon_sum=sign * lon,
+            )
+            for zoom, x, y in tiles
+        ]
+    )
+    upsert = upsert.on_conflict_do_update(
+        index_elements=["zoom", "x", "y"],
+        set_=dict(
+            count=GroupCluster.count + upsert.excluded.count,
+            houses=GroupCluster.houses + upsert.excluded.houses,
+            lat_sum=GroupCluster.lat_sum + upsert.excluded.lat_sum,
+            lon_sum=GroupCluster.lon_sum + upsert.excluded.lon_sum,
+        ),
+    )
+    await db.exec(upsert)  # type: ignore
+
+    if sign < 0:
+        await db.exec(
+            delete(GroupCluster).where(  # type: ignore
+                tuple_(
+                    col(GroupCluster.zoom), col(GroupCluster.x), col(GroupCluster.y)
+                ).in_(tiles),
+                col(GroupCluster.count) <= 0,
+            )
+        )
+
+
+def locate(boxes: list[BoundingBox]):
+    """
+    This function returns a query selecting the IDs of all groups that lie
+    within any of the given bounding boxes.
+    """
+    # Each box gets its own SELECT so that SQLite can use the R*Tree for every
+    # one of them, which it cannot do for an OR of constraints.
+    return union_all(
+        *[
+            select(group_location.c.id).where(
+                group_location.c.max_lat >= box.min_lat,
+                group_location.c.min_lat <= box.max_lat,
+                group_location.c.max_lon >= box.min_lon,
+                group_location.c.min_lon <= box.max_lon,
+            )
+            for box in boxes
+        ]
+    )
@@ -2,7 +2,7 @@
 
 from dataclasses import dataclass
 from faker import Faker
-from db import Database
+from db import Database, Loader
 from db.models import *
 from db.consts import PRONOUNS, GENDERS, SEXUAL_ORIENTATIONS
 from api.me import RegisterRequest, register
@@ -109,7 +109,7 @@ async def generate_one_user(i: int, db: Database):
         group = random_group()
         group.icon_hash = await ensure_asset(cat_asset.data, cat_asset.content_type, db)
 
-        await create_group(group, db=db, me_id=user_id)
+        await create_group(group, db=db, loader=Loader.of(db), me_id=user_id)
         print(f"Generated group for above user")
 
 
@@ -240,9 +240,9 @@ async def ensure_asset(
     hash = hash_bytes(data)
     asset = await db.get(Asset, hash)
     if asset is None:
+        await database.blobs.store.put(hash, data)
         asset = Asset(
             hash=hash,
-            data=data,
             content_type=content_type,
             alt=alt,
         )
@@ -258,12 +258,14 @@ def roll(p) -> bool:
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--database", type=str, default=":memory:")
+    parser.add_argument("--assets", type=str, default="assets")
     parser.add_argument("--seed", type=int, default=38474)
 
     args = parser.parse_args()
 
     random.seed(args.seed)
     database.set_sqlite_path(args.database)
+    database.blobs.set_store(database.blobs.FileBlobStore(args.assets))
 
     asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     uvloop.run(generate())
@@ -8,18 +8,29 @@ import uvicorn
 import argparse
 from fastapi_pagination import add_pagination
 from api import chat
+from utils.broadcast import Broadcast
+from viewlevels.group import sync_group_access
+import asyncio
 
 
 @asynccontextmanager
 async def with_init(_: FastAPI):
     await db.init_db()
     await chat.broadcast.connect()
+    # Access invalidations go through the same backend as live chat, but are
+    # kept out of its subscriber counts.
+    access_broadcast = Broadcast(chat.broadcast.url)
+    await access_broadcast.connect()
+    access_sync = asyncio.create_task(sync_group_access(access_broadcast))
     yield
+    access_sync.cancel()
+    await access_broadcast.disconnect()
     await chat.broadcast.disconnect()
 
 
 app = FastAPI(lifespan=with_init)
 app.include_router(api.router)
+add_pagination(app)
 
 
 if __name__ == "__main__":
@@ -27,6 +38,17 @@ if __name__ == "__main__":
     parser.add_argument("-H", "--host", default="127.0.0.1", help="The host to bind to")
     parser.add_argument("-p", "--port", default=5765, help="Port to bind to", type=int)
     parser.add_argument("--database", default="database.db", help="Path to database")
+    parser.add_argument(
+        "--assets",
+        default="assets",
+        help="Directory to store the data of assets in",
+    )
+    parser.add_argument(
+        "--broadcast",
+        default="memory://",
+        help="URL of the live chat broadcast backend;"
+        " use sqlite:///path/to/file.db to share it between server processes",
+    )
     parser.add_argument(
         "--echo-sql",
         action="store_true",
@@ -36,6 +58,7 @@ if __name__ == "__main__":
     args = parser.parse_args()
     db.set_sqlite_path(args.database)
     db.set_echo(args.echo_sql)
-    add_pagination(app)
+    db.blobs.set_store(db.blobs.FileBlobStore(args.assets))
+    chat.set_broadcast_url(args.broadcast)
 
     uvicorn.run(app, host=args.host, port=args.port)
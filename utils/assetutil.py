@@ -3,4 +3,8 @@ import base64
 
 
 def hash_bytes(data: bytes) -> str:
-    return base64.urlsafe_b64encode(hashlib.sha256(data).digest()).decode("utf-8")
+    return encode_hash(hashlib.sha256(data).digest())
+
+
+def encode_hash(digest: bytes) -> str:
+    return base64.urlsafe_b64encode(digest).decode("utf-8")
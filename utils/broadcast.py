@@ -0,0 +1,272 @@
+from broadcaster import Broadcast as _Broadcast, Event
+from broadcaster._backends.base import BroadcastBackend
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Literal, Optional
+from urllib.parse import parse_qs, urlparse
+import aiosqlite
+import asyncio
+import logging
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+# SlowSubscriberPolicy is what happens when a subscriber's queue is full:
+# "drop-oldest" drops its oldest queued message to make room, and "disconnect"
+# ends its subscription so that it can resume later.
+SlowSubscriberPolicy = Literal["drop-oldest", "disconnect"]
+
+
+@dataclass
+class BroadcastStats:
+    """
+    BroadcastStats counts the subscribers of a Broadcast in this process.
+    """
+
+    # subscribers is the number of current subscriptions.
+    subscribers: int = 0
+    # queued is the number of messages waiting in all subscriber queues.
+    queued: int = 0
+    # dropped is the number of messages that were dropped from full queues.
+    dropped: int = 0
+    # disconnected is the number of subscriptions that were ended because
+    # their queue was full.
+    disconnected: int = 0
+
+
+class Broadcast(_Broadcast):
+    """
+    Broadcast is broadcaster's Broadcast with an additional sqlite:// backend,
+    which shares messages between processes on the same machine without
+    needing a separate server.
+
+    The URL is either one that broadcaster understands, such as memory://, or
+    sqlite:///path/to/file.db in the same form that SQLAlchemy uses. See
+    SQLiteBackend for its query parameters.
+
+    Unlike broadcaster's, each subscriber only queues up to queue_size messages,
+    so one stalled subscriber cannot hold up the others or grow memory without
+    bound. What happens to a subscriber that falls behind is decided by
+    slow_subscribers.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        queue_size: int = 256,
+        slow_subscribers: SlowSubscriberPolicy = "disconnect",
+    ):
+        self.url = url
+        if urlparse(url).scheme == "sqlite":
+            self._subscribers = {}
+            self._backend = SQLiteBackend(url)
+        else:
+            super().__init__(url)
+
+        self.queue_size = queue_size
+        self.slow_subscribers = slow_subscribers
+        self.stats = BroadcastStats()
+
+    async def _listener(self) -> None:
+        while True:
+            event = await self._backend.next_published()
+            for subscriber in list(self._subscribers.get(event.channel, [])):
+                subscriber.put(event)
+
+    @asynccontextmanager
+    async def subscribe(self, channel: str) -> AsyncIterator["Subscriber"]:  # type: ignore
+        subscriber = Subscriber(self)
+        self.stats.subscribers += 1
+
+        try:
+            if not self._subscribers.get(channel):
+                await self._backend.subscribe(channel)
+                self._subscribers[channel] = set([subscriber])
+            else:
+                self._subscribers[channel].add(subscriber)
+
+            yield subscriber
+        finally:
+            self.stats.subscribers -= 1
+            subscriber.close()
+
+            subscribers = self._subscribers.get(channel)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[channel]
+                    await self._backend.unsubscribe(channel)
+
+
+class Unsubscribed(Exception):
+    """
+    Unsubscribed is raised when getting a message from a closed Subscriber.
+    """
+
+
+class Subscriber:
+    """
+    Subscriber is a subscription to a Broadcast channel with a bounded queue.
+    Iterating over it yields its messages until it is closed.
+    """
+
+    def __init__(self, broadcast: Broadcast):
+        self._broadcast = broadcast
+        self._events: deque[Event] = deque()
+        self._ready = asyncio.Event()
+        self.closed = False
+
+    def put(self, event: Event) -> None:
+        if self.closed:
+            return
+
+        stats = self._broadcast.stats
+        if len(self._events) >= self._broadcast.queue_size:
+            stats.dropped += 1
+            if self._broadcast.slow_subscribers == "disconnect":
+                stats.disconnected += 1
+                self.close()
+                return
+
+            self._events.popleft()
+            stats.queued -= 1
+
+        self._events.append(event)
+        stats.queued += 1
+        self._ready.set()
+
+    def close(self) -> None:
+        self._broadcast.stats.queued -= len(self._events)
+        self._events.clear()
+        self.closed = True
+        self._ready.set()
+
+    async def get(self) -> Event:
+        while not self._events:
+            if self.closed:
+                raise Unsubscribed()
+            self._ready.clear()
+            await self._ready.wait()
+
+        self._broadcast.stats.queued -= 1
+        return self._events.popleft()
+
+    async def __aiter__(self) -> AsyncIterator[Event]:
+        try:
+            while True:
+                yield await self.get()
+        except Unsubscribed:
+            pass
+
+
+class SQLiteBackend(BroadcastBackend):
+    """
+    SQLiteBackend publishes messages by appending them to a log table in an
+    SQLite database. Every connected process polls the table for rows newer
+    than the last one it has seen, so all processes that use the same file
+    receive every message.
+
+    Like broadcaster's other cross-process backends, messages must be strings.
+
+    The URL accepts two query parameters: interval is how often the log is
+    polled in seconds (default 0.05), and retention is how long messages are
+    kept in the log in seconds (default 60).
+    """
+
+    def __init__(self, url: str):
+        parsed = urlparse(url)
+        query = parse_qs(parsed.query)
+
+        self._path = parsed.path[1:]
+        self._interval = float(query.get("interval", ["0.05"])[0])
+        self._retention = float(query.get("retention", ["60"])[0])
+
+        self._conn: Optional[aiosqlite.Connection] = None
+        self._poller: Optional[asyncio.Task] = None
+        self._published: asyncio.Queue[Event] = asyncio.Queue()
+        self._subscribed: set[str] = set()
+        self._last_id = 0
+        self._last_prune = 0.0
+
+    async def connect(self) -> None:
+        self._conn = await aiosqlite.connect(self._path, isolation_level=None)
+        await self._conn.execute("PRAGMA journal_mode=wal")
+        await self._conn.execute("PRAGMA busy_timeout=5000")
+        # AUTOINCREMENT keeps IDs from being reused once old rows are pruned,
+        # which would otherwise hide new messages from other processes.
+        await self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS notification ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " channel TEXT NOT NULL,"
+            " message TEXT NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+
+        # Only deliver messages published from now on.
+        async with self._conn.execute(
+            "SELECT coalesce(max(id), 0) FROM notification"
+        ) as cursor:
+            (self._last_id,) = await cursor.fetchone()  # type: ignore
+
+        self._poller = asyncio.create_task(self._poll())
+
+    async def disconnect(self) -> None:
+        if self._poller is not None:
+            self._poller.cancel()
+            self._poller = None
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+    # The parameters are named like BroadcastBackend's, which calls channels
+    # groups here.
+    async def subscribe(self, group: str) -> None:
+        self._subscribed.add(group)
+
+    async def unsubscribe(self, group: str) -> None:
+        self._subscribed.discard(group)
+
+    async def publish(self, channel: str, message: Any) -> None:
+        assert self._conn is not None, "must connect before publishing"
+        await self._conn.execute(
+            "INSERT INTO notification (channel, message, created_at)"
+            " VALUES (?, ?, ?)",
+            (channel, message, time.time()),
+        )
+
+    # BroadcastBackend declares a tuple, but Broadcast reads the channel and
+    # message of an Event, which is what broadcaster's own backends return.
+    async def next_published(self) -> Event:  # type: ignore
+        return await self._published.get()
+
+    async def _poll(self) -> None:
+        while True:
+            try:
+                await self._poll_once()
+            except sqlite3.Error:
+                # The log may be locked by another process for longer than
+                # the busy timeout. Polling again picks up where it left off.
+                logger.exception("polling the broadcast log failed")
+
+            await asyncio.sleep(self._interval)
+
+    async def _poll_once(self) -> None:
+        assert self._conn is not None
+        async with self._conn.execute(
+            "SELECT id, channel, message FROM notification" " WHERE id > ? ORDER BY id",
+            (self._last_id,),
+        ) as cursor:
+            async for id, channel, message in cursor:
+                self._last_id = id
+                if channel in self._subscribed:
+                    self._published.put_nowait(Event(channel, message))
+
+        now = time.time()
+        if now - self._last_prune >= self._retention / 2:
+            self._last_prune = now
+            await self._conn.execute(
+                "DELETE FROM notification WHERE created_at < ?",
+                (now - self._retention,),
+            )
@@ -0,0 +1,58 @@
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Generic, Hashable, Iterator, Optional, TypeVar
+import time
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class TTLCache(Generic[K, V]):
+    """
+    TTLCache is a bounded in-process cache. Once it is full, the least recently
+    used entry is evicted, and entries older than the TTL are never returned.
+
+    The cache is local to the process, so the TTL also bounds how long a write
+    made by another process can go unnoticed.
+    """
+
+    def __init__(self, maxsize: int, ttl: timedelta):
+        self.maxsize = maxsize
+        self.ttl = ttl.total_seconds()
+        self._entries: OrderedDict[K, tuple[float, V]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: K) -> Optional[V]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: K, value: V) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def pop(self, key: K) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def items(self) -> Iterator[tuple[K, V]]:
+        """
+        This function iterates over a snapshot of the cache's entries, so
+        entries may be popped while iterating.
+        """
+        for key, (_, value) in list(self._entries.items()):
+            yield key, value
@@ -0,0 +1,183 @@
+from dataclasses import dataclass
+from haversine import Unit as DistanceUnit
+from haversine.haversine import get_avg_earth_radius
+import math
+import numpy as np
+
+
+@dataclass
+class BoundingBox:
+    """
+    A latitude/longitude rectangle. The box never crosses the antimeridian,
+    so min_lon is always less than or equal to max_lon.
+    """
+
+    min_lat: float
+    min_lon: float
+    max_lat: float
+    max_lon: float
+
+    def intersects(self, other: "BoundingBox") -> bool:
+        return (
+            self.min_lat <= other.max_lat
+            and other.min_lat <= self.max_lat
+            and self.min_lon <= other.max_lon
+            and other.min_lon <= self.max_lon
+        )
+
+
+def bounding_boxes(
+    lat: float,
+    lon: float,
+    radius: float,
+    unit: DistanceUnit,
+) -> list[BoundingBox]:
+    """
+    This function returns the bounding boxes that together cover every point
+    within the given radius of the given point. Usually there is only one box,
+    but a circle crossing the antimeridian is split into two.
+    """
+    distance = radius / get_avg_earth_radius(unit)  # angular distance in radians
+    dlat = math.degrees(distance)
+    min_lat = lat - dlat
+    max_lat = lat + dlat
+
+    # The circle covers a pole, so every longitude is in range.
+    if min_lat <= -90 or max_lat >= 90:
+        return [BoundingBox(max(min_lat, -90), -180, min(max_lat, 90), 180)]
+
+    dlon = math.degrees(math.asin(math.sin(distance) / math.cos(math.radians(lat))))
+    min_lon = lon - dlon
+    max_lon = lon + dlon
+
+    if min_lon < -180:
+        return [
+            BoundingBox(min_lat, min_lon + 360, max_lat, 180),
+            BoundingBox(min_lat, -180, max_lat, max_lon),
+        ]
+    if max_lon > 180:
+        return [
+            BoundingBox(min_lat, min_lon, max_lat, 180),
+            BoundingBox(min_lat, -180, max_lat, max_lon - 360),
+        ]
+
+    return [BoundingBox(min_lat, min_lon, max_lat, max_lon)]
+
+
+# MAX_MERCATOR_LAT is the latitude at which Web Mercator maps are cut off.
+MAX_MERCATOR_LAT = 85.0511287798066
+
+
+def tile(lat: float, lon: float, zoom: int) -> tuple[int, int]:
+    """
+    This function returns the x and y of the Web Mercator map tile that
+    contains the given point at the given zoom level, as used by slippy maps.
+    """
+    n = 2**zoom
+    lat = math.radians(max(-MAX_MERCATOR_LAT, min(MAX_MERCATOR_LAT, lat)))
+    x = int((lon + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(lat)) / math.pi) / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def snap_distance(grid: float, unit: DistanceUnit) -> float:
+    """
+    This function returns how far any point can be from the nearest point of a
+    latitude/longitude grid with the given spacing in degrees.
+    """
+    # Snapping moves both the latitude and the longitude by at most half of
+    # the spacing; see inner_box for the bound this gives.
+    half = math.radians(grid / 2)
+    return 2 * get_avg_earth_radius(unit) * math.asin(math.sqrt(2) * math.sin(half / 2))
+
+
+def distances(
+    lat: float,
+    lon: float,
+    lats: np.ndarray,
+    lons: np.ndarray,
+    unit: DistanceUnit,
+) -> np.ndarray:
+    """
+    This function returns the haversine distance from the given point to every
+    point in lats and lons at once. It computes the same values as
+    haversine.haversine, but over whole arrays.
+    """
+    lat1 = math.radians(lat)
+    lon1 = math.radians(lon)
+    lat2 = np.radians(lats)
+    lon2 = np.radians(lons)
+
+    d = (
+        np.sin((lat2 - lat1) * 0.5) ** 2
+        + math.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) * 0.5) ** 2
+    )
+    return 2 * get_avg_earth_radius(unit) * np.arcsin(np.sqrt(d))
+
+
+def inner_box(
+    lat: float,
+    lon: float,
+    radius: float,
+    unit: DistanceUnit,
+) -> BoundingBox | None:
+    """
+    This function returns a bounding box that lies entirely within the given
+    radius of the given point, or None if no such box fits without crossing a
+    pole or the antimeridian.
+    """
+    distance = radius / get_avg_earth_radius(unit)
+    if distance >= math.pi:
+        return None
+
+    # Within the box, both the latitude and the longitude differ by at most
+    # half, which bounds the haversine term by 2 * sin(half / 2)^2. Solve that
+    # for the distance, then shrink it a little to stay clear of rounding
+    # errors at the edges.
+    half = math.degrees(2 * math.asin(math.sin(distance / 2) / math.sqrt(2)))
+    half *= 1 - 1e-6
+
+    box = BoundingBox(lat - half, lon - half, lat + half, lon + half)
+    if box.min_lat < -90 or box.max_lat > 90:
+        return None
+    if box.min_lon < -180 or box.max_lon > 180:
+        return None
+    return box
+
+
+def nearest(
+    lat: float,
+    lon: float,
+    lats: np.ndarray,
+    lons: np.ndarray,
+    ids: np.ndarray,
+    radius: float,
+    limit: int,
+    unit: DistanceUnit,
+    after: tuple[float, int] | None = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    This function returns the indices of the (at most) limit points nearest to
+    the given point that lie within the radius, along with their distances.
+    Both arrays are ordered by distance, then by ID.
+
+    If after is given as a (distance, ID) pair, only the points that are
+    ordered after it are considered.
+    """
+    d = distances(lat, lon, lats, lons, unit)
+    mask = d <= radius
+    if after is not None:
+        after_distance, after_id = after
+        mask &= (d > after_distance) | ((d == after_distance) & (ids > after_id))
+
+    within = np.flatnonzero(mask)
+    if limit <= 0:
+        within = within[:0]
+    elif len(within) > limit:
+        # Only fully sort the points that can make it into the result. Every
+        # point tied with the last one is kept so that the IDs decide.
+        kth = np.partition(d[within], limit - 1)[limit - 1]
+        within = within[d[within] <= kth]
+
+    within = within[np.lexsort((ids[within], d[within]))][:limit]
+    return within, d[within]
@@ -0,0 +1,134 @@
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from starlette.types import Receive, Scope, Send
+from typing import Optional
+import anyio
+import re
+
+_RANGE = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+class RangeNotSatisfiable(Exception):
+    """
+    RangeNotSatisfiable is raised for a range that lies outside of the file.
+    """
+
+
+def parse_range(header: str, size: int) -> Optional[tuple[int, int]]:
+    """
+    This function parses a Range header for a resource of the given size and
+    returns the first and last byte of the requested range. It returns None if
+    the header should be ignored, such as when it is malformed or asks for
+    several ranges at once, and raises RangeNotSatisfiable if the range lies
+    outside of the resource.
+    """
+    match = _RANGE.fullmatch(header.strip())
+    if match is None:
+        return None
+
+    start, end = match.groups()
+    if not start and not end:
+        return None
+
+    if not start:
+        # A suffix range, which asks for the last bytes.
+        length = int(end)
+        if length == 0 or size == 0:
+            raise RangeNotSatisfiable()
+        return max(size - length, 0), size - 1
+
+    first = int(start)
+    if end and int(end) < first:
+        return None
+    if first >= size:
+        raise RangeNotSatisfiable()
+    return first, min(int(end), size - 1) if end else size - 1
+
+
+class RangeFileResponse(FileResponse):
+    """
+    RangeFileResponse is a FileResponse that also answers Range requests with
+    the requested part of the file, so that downloads can be resumed or only
+    partially fetched.
+
+    If the server supports the ASGI zero-copy send extension, the file is
+    handed to the server to send with sendfile. Otherwise, it is sent in chunks
+    that are read off the event loop.
+
+    A stat_result must be given.
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        assert self.stat_result is not None, "RangeFileResponse needs stat_result"
+        size = self.stat_result.st_size
+        self.headers["accept-ranges"] = "bytes"
+
+        first, last = 0, size - 1
+        request_headers = Headers(scope=scope)
+        range_header = request_headers.get("range")
+        if_range = request_headers.get("if-range")
+        if range_header and (if_range is None or if_range == self.headers.get("etag")):
+            try:
+                requested = parse_range(range_header, size)
+            except RangeNotSatisfiable:
+                self.status_code = 416
+                self.headers["content-range"] = f"bytes */{size}"
+                self.headers["content-length"] = "0"
+                await self._send_start(send)
+                await send({"type": "http.response.body", "body": b""})
+                return
+
+            if requested is not None:
+                first, last = requested
+                self.status_code = 206
+                self.headers["content-range"] = f"bytes {first}-{last}/{size}"
+                self.headers["content-length"] = str(last - first + 1)
+
+        await self._send_start(send)
+        if scope["method"].upper() == "HEAD" or size == 0:
+            await send({"type": "http.response.body", "body": b""})
+        else:
+            await self._send_file(scope, send, first, last - first + 1)
+
+        if self.background is not None:
+            await self.background()
+
+    async def _send_start(self, send: Send) -> None:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+
+    async def _send_file(
+        self, scope: Scope, send: Send, offset: int, count: int
+    ) -> None:
+        if "http.response.zerocopysend" in scope.get("extensions", {}):
+            with open(self.path, "rb") as file:
+                await send(
+                    {
+                        "type": "http.response.zerocopysend",
+                        "file": file,
+                        "offset": offset,
+                        "count": count,
+                    }
+                )
+            return
+
+        async with await anyio.open_file(self.path, mode="rb") as file:
+            await file.seek(offset)
+            while count > 0:
+                chunk = await file.read(min(self.chunk_size, count))
+                if not chunk:
+                    # The file shrank while being sent, which blobs never do.
+                    raise RuntimeError(f"File at path {self.path} is too short.")
+                count -= len(chunk)
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": chunk,
+                        "more_body": count > 0,
+                    }
+                )
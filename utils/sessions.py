@@ -1,4 +1,4 @@
-from typing import AsyncGenerator
+from typing import AsyncGenerator, Optional
 from fastapi import HTTPException, Header, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from db import Database
@@ -23,18 +23,27 @@ async def authorize(
     This function asserts the authorization header and returns the user ID if
     the token is valid.
     """
+    user_id = await session_user_id(db, creds.credentials)
+    if user_id is None:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    yield user_id
+
 
-    authorization = creds.credentials
+async def session_user_id(db: Database, token: str) -> Optional[int]:
+    """
+    This function returns the ID of the user that the session token belongs
+    to, or None if the token is not valid. Use this where the authorize
+    dependency cannot be, such as in WebSocket routes.
+    """
     now = datetime.now()
 
     session_query = await db.exec(
-        select(Session).where(
-            Session.token == authorization and Session.expires_at > now
-        )
+        select(Session).where(Session.token == token and Session.expires_at > now)
     )
     session = session_query.first()
     if session is None:
-        raise HTTPException(status_code=401, detail="Unauthorized")
+        return None
 
     # If the session is after the renew threshold, renew the session.
     # Don't always renew the session, as that would force a database write on
@@ -46,7 +55,7 @@ async def authorize(
             await db.commit()
 
     assert session.user_id is not None
-    yield session.user_id
+    return session.user_id
 
 
 def new_session(db: Database, user_id: int) -> Session:
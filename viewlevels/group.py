@@ -1,8 +1,17 @@
+from dataclasses import dataclass
+from datetime import timedelta
 from fastapi import HTTPException
-from sqlmodel import select
-from db import Database
+from sqlmodel import select, col
+from typing import Sequence
+from db import Database, Loader, on_commit, on_transaction_end
 from db.models import *
+from utils.broadcast import Broadcast
+from utils.cache import TTLCache
+import asyncio
 import db
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 async def owns_group(
@@ -13,9 +22,8 @@ async def owns_group(
     """
     This function returns True if the current user owns the specified group.
     """
-    return (
-        await db.exec(select(User.group_id).where(User.id == me_id))
-    ).first() == group_id
+    me = await Loader.of(db).get(User, me_id)
+    return me is not None and me.group_id == group_id
 
 
 async def assert_owns_group(
@@ -34,11 +42,177 @@ async def assert_owns_group(
         )
 
 
+@dataclass
+class GroupAccess:
+    """
+    GroupAccess describes what a user may do in a group.
+    """
+
+    # level is the user's access level in the group, or None if the user is
+    # neither in the group nor has a relationship with it.
+    level: AccessLevel | None
+    open_dms: bool
+
+
+# _access_cache caches the GroupAccess of every (user_id, group_id) pair that
+# was looked up recently. Writes that change a user's access to a group must
+# call invalidate_group_access.
+#
+# Only existing relationships are cached. A missing one is looked up again
+# every time, so that a relationship created by another server process shows
+# up right away instead of once the entry expires.
+#
+# Other server processes drop their entries once the invalidation reaches them
+# through the broadcast, which takes a moment. Access is therefore never
+# refused based on the cache alone: a cached entry that would refuse it is
+# looked up again first.
+_access_cache: TTLCache[tuple[int, int], GroupAccess] = TTLCache(
+    maxsize=65536,
+    ttl=timedelta(minutes=5),
+)
+
+# ACCESS_CHANNEL is the broadcast channel that invalidations of the access
+# cache are sent through. Its messages are "group_id:user_id", or
+# "group_id:" for every user in the group.
+ACCESS_CHANNEL = "group_access"
+
+# _broadcast is the broadcast that invalidations are sent through while
+# sync_group_access runs.
+_broadcast: Broadcast | None = None
+
+# _publishing holds the invalidations that are still being sent, so that their
+# tasks are not garbage collected.
+_publishing: set[asyncio.Task] = set()
+
+
+def _drop_group_access(group_id: int, user_id: int | None) -> None:
+    if user_id is not None:
+        _access_cache.pop((user_id, group_id))
+        return
+
+    for key, _ in _access_cache.items():
+        if key[1] == group_id:
+            _access_cache.pop(key)
+
+
+async def _publish_group_access(message: str) -> None:
+    if _broadcast is None:
+        return
+
+    try:
+        await _broadcast.publish(channel=ACCESS_CHANNEL, message=message)
+    except Exception:
+        # Other processes still drop their entries once they expire.
+        logger.exception("publishing access invalidation %s failed", message)
+
+
+def invalidate_group_access(
+    db: Database,
+    group_id: int,
+    user_id: int | None = None,
+) -> None:
+    """
+    This function drops the cached access of the user in the group once the
+    current transaction ends. If no user is given, the cached access of every
+    user in the group is dropped.
+
+    The entries are also dropped if the transaction is rolled back, since
+    lookups made during it may have cached its uncommitted writes. Once the
+    transaction is committed, other server processes are told to drop theirs.
+    """
+    on_transaction_end(db, lambda: _drop_group_access(group_id, user_id))
+
+    def publish():
+        message = f"{group_id}:{user_id if user_id is not None else ''}"
+        task = asyncio.get_running_loop().create_task(_publish_group_access(message))
+        _publishing.add(task)
+        task.add_done_callback(_publishing.discard)
+
+    on_commit(db, publish)
+
+
+async def sync_group_access(broadcast: Broadcast) -> None:
+    """
+    This function sends invalidations of the access cache through the given
+    broadcast and applies the ones sent by every server process, including
+    this one. It runs until it is cancelled.
+    """
+    global _broadcast
+    _broadcast = broadcast
+    try:
+        while True:
+            async with broadcast.subscribe(channel=ACCESS_CHANNEL) as subscriber:
+                async for event in subscriber:
+                    group_id, _, user_id = event.message.partition(":")
+                    _drop_group_access(int(group_id), int(user_id) if user_id else None)
+
+            # The subscription fell behind and was dropped, so invalidations
+            # may have been missed.
+            _access_cache.clear()
+    finally:
+        _broadcast = None
+
+
+async def group_accesses(
+    db: Database,
+    me_id: int,
+    group_ids: Sequence[int],
+    cached: bool = True,
+) -> dict[int, GroupAccess]:
+    """
+    This function returns the GroupAccess of the current user in each of the
+    specified groups. Groups missing from the cache are loaded all at once.
+    If cached is False, every group is loaded and the cache is refreshed.
+    """
+    accesses: dict[int, GroupAccess] = {}
+    missing: list[int] = []
+    for group_id in group_ids:
+        access = _access_cache.get((me_id, group_id)) if cached else None
+        if access is None:
+            missing.append(group_id)
+        else:
+            accesses[group_id] = access
+
+    if not missing:
+        return accesses
+
+    relationships = (
+        await db.exec(
+            select(GroupRelationship).where(
+                GroupRelationship.user_id == me_id,
+                col(GroupRelationship.group_id).in_(missing),
+            )
+        )
+    ).all()
+    relationships_by_group = {r.group_id: r for r in relationships}
+
+    me = await Loader.of(db).get(User, me_id)
+    my_group_id = me.group_id if me else None
+
+    for group_id in missing:
+        relationship = relationships_by_group.get(group_id)
+        access = GroupAccess(
+            level=relationship.level if relationship else None,
+            open_dms=relationship.open_dms if relationship else False,
+        )
+        if group_id == my_group_id:
+            access.level = AccessLevel.HIGHEST
+
+        if access.level is not None or access.open_dms:
+            _access_cache.set((me_id, group_id), access)
+        else:
+            _access_cache.pop((me_id, group_id))
+        accesses[group_id] = access
+
+    return accesses
+
+
 async def group_level(
     db: Database,
     me_id: int,
     group_id: int,
     default=AccessLevel.PUBLIC,
+    cached: bool = True,
 ) -> AccessLevel:
     """
     This function returns the access level of the current user in the specified
@@ -46,21 +220,27 @@ async def group_level(
 
     If the user is part of this group, then the highest access level is implied.
     """
-    if await owns_group(db, me_id, group_id):
-        return AccessLevel.HIGHEST
+    return (await group_levels(db, me_id, [group_id], default, cached))[group_id]
 
-    relationship = (
-        await db.exec(
-            select(GroupRelationship).where(
-                GroupRelationship.user_id == me_id
-                and GroupRelationship.group_id == group_id
-            )
-        )
-    ).first()
-    if relationship is None:
-        return default
 
-    return relationship.level
+async def group_levels(
+    db: Database,
+    me_id: int,
+    group_ids: Sequence[int],
+    default=AccessLevel.PUBLIC,
+    cached: bool = True,
+) -> dict[int, AccessLevel]:
+    """
+    This function returns the access level of the current user in each of the
+    specified groups, in a fixed number of queries.
+
+    If the user is part of a group, then the highest access level is implied.
+    """
+    accesses = await group_accesses(db, me_id, group_ids, cached)
+    return {
+        group_id: access.level if access.level is not None else default
+        for group_id, access in accesses.items()
+    }
 
 
 async def assert_group_level(
@@ -78,6 +258,9 @@ async def assert_group_level(
     """
     if actual_level is None:
         actual_level = await group_level(db, me_id, group_id)
+    if actual_level < level:
+        # The level may be stale, so look it up again before refusing.
+        actual_level = await group_level(db, me_id, group_id, cached=False)
 
     if actual_level < level:
         raise HTTPException(
@@ -95,15 +278,13 @@ async def group_open_dms(
     This function returns True if the current user has open DMs with the
     specified group.
     """
-    open_dms = (
-        await db.exec(
-            select(GroupRelationship.open_dms).where(
-                GroupRelationship.user_id == me_id
-                and GroupRelationship.group_id == group_id
-            )
-        )
-    ).first()
-    return open_dms == True
+    access = _access_cache.get((me_id, group_id))
+    if access is None or not access.open_dms:
+        # The cache is only trusted when it allows DMs, so that a stale entry
+        # cannot refuse them.
+        accesses = await group_accesses(db, me_id, [group_id], cached=False)
+        access = accesses[group_id]
+    return access.open_dms
 
 
 async def assert_group_open_dms(
@@ -1,9 +1,11 @@
-from db import Database
+from db import Database, Loader
+from fastapi import HTTPException
 from db.models import *
-from viewlevels.group import group_level
+from viewlevels.group import group_level, group_levels
 from pydantic import BaseModel, Field
-from sqlmodel import select
-from typing import Annotated, Sequence, Union, Literal
+from sqlmodel import select, col
+from typing import Annotated, Iterable, Sequence, Union, Literal
+from collections import defaultdict
 
 
 class PublicUserData(BaseModel):
@@ -52,40 +54,46 @@ UserView = Annotated[
 ]
 
 
+# _VIEW_MODELS maps each access level to the UserView model shown at it.
+_VIEW_MODELS: dict[
+    AccessLevel, type[PublicUser | Level1User | Level2User | Level3User]
+] = {
+    AccessLevel.PUBLIC: PublicUser,
+    AccessLevel.LEVEL1: Level1User,
+    AccessLevel.LEVEL2: Level2User,
+    AccessLevel.LEVEL3: Level3User,
+}
+
+# _VIEW_USER_FIELDS maps each access level to the fields of its UserView model
+# that are copied straight from the User row. The others are filled in by
+# user_view.
+_VIEW_USER_FIELDS: dict[AccessLevel, list[str]] = {
+    level: [
+        name
+        for name in model.model_fields
+        if name not in ("access_level", "group", "photo_hashes")
+    ]
+    for level, model in _VIEW_MODELS.items()
+}
+
+
 def user_view(
     level: AccessLevel,
     user: User,
     group: Optional[Group],
     photos: Sequence[UserPhoto],
 ) -> UserView:
-    # Start out with the most privileged view, then drill down to the more
-    # public views by excluding fields.
-    view = Level3User(
-        **user.model_dump(),
-        access_level=AccessLevel.LEVEL3,
-        group=group,
-        photo_hashes=[photo.photo_hash for photo in photos],  # type: ignore
-    )
-
-    if level <= AccessLevel.LEVEL2:
-        view = Level2User(
-            **view.model_dump(exclude={"access_level"}),
-            access_level=AccessLevel.LEVEL2,
-        )
-
-    if level <= AccessLevel.LEVEL1:
-        view = Level1User(
-            **view.model_dump(exclude={"access_level"}),
-            access_level=AccessLevel.LEVEL1,
-        )
-
-    if level <= AccessLevel.PUBLIC:
-        view = PublicUser(
-            **view.model_dump(exclude={"access_level"}),
-            access_level=AccessLevel.PUBLIC,
-        )
-
-    return view
+    # Only pick the fields that the level allows, then build and validate the
+    # view model just once.
+    model = _VIEW_MODELS[level]
+    view = {name: getattr(user, name) for name in _VIEW_USER_FIELDS[level]}
+    view["access_level"] = level
+    if "group" in model.model_fields:
+        view["group"] = group
+    if "photo_hashes" in model.model_fields:
+        view["photo_hashes"] = [photo.photo_hash for photo in photos]
+
+    return model(**view)
 
 
 async def user_view_from_db(db: Database, me_id: int, user_id: int) -> "UserView":
@@ -93,19 +101,98 @@ async def user_view_from_db(db: Database, me_id: int, user_id: int) -> "UserView
     This function returns a UserView object, which is a view of a user's profile
     that is tailored to the current user's access level.
     """
-    user = await db.get_one(User, user_id)
-    group = await db.get_one(Group, user.group_id) if user.group_id else None
+    user = await Loader.of(db).get(User, user_id)
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    return (await user_views(db, me_id, [user]))[user_id]
+
+
+async def user_views_from_db(
+    db: Database,
+    me_id: int,
+    user_ids: Iterable[int],
+) -> dict[int, "UserView"]:
+    """
+    This function returns the UserView of every given user, keyed by user ID,
+    in a fixed number of queries. Users that do not exist are left out.
+    """
+    users = await Loader.of(db).get_many(User, set(user_ids))
+    return await user_views(db, me_id, list(users.values()))
+
+
+async def user_views_by_level(
+    db: Database, user: User
+) -> dict[AccessLevel, "UserView"]:
+    """
+    This function returns the view of the user at every access level. The
+    user's group and photos are only loaded once for all of them.
+    """
+    group = None
+    if user.group_id is not None:
+        group = await Loader.of(db).get(Group, user.group_id)
+
     photos = (
-        await db.exec(select(UserPhoto).where(UserPhoto.user_id == user_id))
+        await db.exec(select(UserPhoto).where(UserPhoto.user_id == user.id))
     ).all()
+    return {level: user_view(level, user, group, photos) for level in AccessLevel}
+
 
-    level = AccessLevel.PUBLIC
+async def user_level(
+    db: Database,
+    me_id: int,
+    user_id: int,
+    group_id: Optional[int],
+) -> AccessLevel:
+    """
+    This function returns the access level that the current user views the
+    given user at, which depends on the user's group. It matches the level
+    that user_views picks.
+    """
     if me_id == user_id:
-        level = AccessLevel.HIGHEST
-    elif group:
-        level = await group_level(db, me_id, group.id)
+        return AccessLevel.HIGHEST
+    if group_id is None:
+        return AccessLevel.PUBLIC
+    return await group_level(db, me_id, group_id)
+
+
+async def user_views(
+    db: Database,
+    me_id: int,
+    users: Sequence[User],
+) -> dict[int, "UserView"]:
+    """
+    This function is like user_views_from_db, but for users that were already
+    loaded. Their groups, photos and the current user's access levels are
+    loaded for all users at once.
+    """
+    user_ids = [user.id for user in users]
+    group_ids = {user.group_id for user in users if user.group_id is not None}
+
+    groups_by_id = await Loader.of(db).get_many(Group, group_ids)
+
+    photos = (
+        await db.exec(select(UserPhoto).where(col(UserPhoto.user_id).in_(user_ids)))
+    ).all()
+    photos_by_user: dict[int, list[UserPhoto]] = defaultdict(list)
+    for photo in photos:
+        photos_by_user[photo.user_id].append(photo)  # type: ignore
+
+    levels = await group_levels(db, me_id, list(group_ids))
+
+    views: dict[int, UserView] = {}
+    for user in users:
+        group = groups_by_id.get(user.group_id) if user.group_id else None
+
+        level = AccessLevel.PUBLIC
+        if me_id == user.id:
+            level = AccessLevel.HIGHEST
+        elif group:
+            level = levels[group.id]
+
+        views[user.id] = user_view(level, user, group, photos_by_user[user.id])
 
-    return user_view(level, user, group, photos)
+    return views
 
 
 if __name__ == "__main__":